@@ -0,0 +1,893 @@
+"""
+asyncio connection engine for the chat server.
+
+Serves the same LOGIN and slash-command protocol as server.py, but every
+client is a pair of tasks (reader + writer) on a single event loop instead
+of an OS thread, and Redis is accessed through redis.asyncio.
+
+Usage: SERVER_ENGINE=asyncio python server.py
+   or: python async_server.py
+"""
+
+import asyncio
+import asyncio.sslproto
+import os
+import resource
+import secrets
+import signal
+import ssl
+import threading
+import time
+
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+
+import framing
+import server as core
+
+# redis.asyncio.RedisCluster has no pub/sub, and the asyncio PubSub has no
+# SSUBSCRIBE; REDIS_CLUSTER always turns REDIS_SHARDED_PUBSUB on.
+if core.REDIS_SHARDED_PUBSUB:
+    raise SystemExit("The asyncio engine supports neither REDIS_CLUSTER nor REDIS_SHARDED_PUBSUB")
+
+READ_LIMIT = int(os.environ.get("ASYNC_READ_LIMIT", str(framing.MAX_LINE_LENGTH)))
+HANDSHAKE_TIMEOUT_SECONDS = float(os.environ.get(
+    "ASYNC_HANDSHAKE_TIMEOUT_SECONDS", str(core.HANDSHAKE_TIMEOUT_SECONDS)))
+LISTEN_BACKLOG = int(os.environ.get("ASYNC_LISTEN_BACKLOG", str(core.LISTEN_BACKLOG)))
+SSL_READ_BUFFER_SIZE = int(os.environ.get("ASYNC_SSL_READ_BUFFER_SIZE", "16384"))
+
+# asyncio preallocates a 256 KiB TLS read buffer per connection, which
+# dominates the footprint of idle clients. One TLS record is at most 16 KiB.
+# StreamWriter.start_tls() builds the private SSLProtocol itself, with no
+# factory to pass a subclass through, so the class attribute is lowered for
+# this process, which only serves this engine. Checked first, since a
+# future Python may size the buffer differently.
+if isinstance(getattr(asyncio.sslproto.SSLProtocol, "max_size", None), int):
+    asyncio.sslproto.SSLProtocol.max_size = SSL_READ_BUFFER_SIZE
+else:
+    print("asyncio.sslproto.SSLProtocol.max_size not found; TLS read buffers keep their default size")
+
+
+class MeteredConnectionPool(aioredis.BlockingConnectionPool):
+
+    def __init__(self, meter, **kwargs):
+        super().__init__(max_connections=meter.size, timeout=core.REDIS_POOL_TIMEOUT_SECONDS, **kwargs)
+        self.meter = meter
+        self.checked_out = {}
+
+    async def get_connection(self, command_name, *keys, **options):
+        self.meter.checkout()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        except BaseException as e:
+            self.meter.failed(isinstance(e, aioredis.ConnectionError) and str(e) == "No connection available.")
+            raise
+        self.checked_out[connection] = (command_name, time.perf_counter())
+        self.meter.acquired()
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        checkout = self.checked_out.pop(connection, None)
+        if checkout is not None:
+            command_name, start = checkout
+            core.redis_seconds.observe(time.perf_counter() - start, command_name.upper())
+            self.meter.released()
+
+
+# Same per-workload split as server.py; these meters count this engine's
+# pools only.
+pool_meters = {
+    workload: core.PoolMeter(workload, meter.size) for workload, meter in core.pool_meters.items()
+}
+
+
+def metered_client(workload):
+    pool = MeteredConnectionPool(
+        pool_meters[workload], decode_responses=True, **core.redis_options(retry_class=Retry)
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+publish_client = metered_client("publish")
+redis_client = metered_client("control")
+heartbeat_client = metered_client("heartbeat")
+
+pubsub_client = aioredis.Redis(**core.redis_options(retry_class=Retry))
+
+remove_room_if_empty_script = redis_client.register_script(core.REMOVE_ROOM_IF_EMPTY_SCRIPT)
+add_user_to_room_script = redis_client.register_script(core.ADD_USER_TO_ROOM_SCRIPT)
+refresh_active_users_script = heartbeat_client.register_script(core.REFRESH_ACTIVE_USERS_SCRIPT)
+release_active_user_script = redis_client.register_script(core.RELEASE_ACTIVE_USER_SCRIPT)
+prune_presence_script = heartbeat_client.register_script(core.PRUNE_PRESENCE_SCRIPT)
+publish_notification_script = publish_client.register_script(core.PUBLISH_NOTIFICATION_SCRIPT)
+reap_node_script = heartbeat_client.register_script(core.REAP_NODE_SCRIPT)
+resume_session_script = redis_client.register_script(core.RESUME_SESSION_SCRIPT)
+
+
+class Session(core.Session):
+    """core.Session whose conn is the StreamWriter and whose outbound is an
+    asyncio.Queue (None once the session has ended)."""
+
+    __slots__ = ("dropped", "reader")
+
+    def __init__(self, conn, user, outbound, reader):
+        super().__init__(conn, user, outbound)
+        self.dropped = 0
+        self.reader = reader
+
+
+# Same indexes as server.py. No lock is needed: everything below runs on
+# one loop.
+sessions = set()
+room_sessions = {core.MAIN_ROOM: set()}
+subscribers = {}
+subscriber_snapshots = {}
+
+# (action, channel) pairs applied by the pub/sub listener task.
+channel_changes = []
+
+# (followers, data) notifications for the notification_delivery task.
+notification_deliveries = asyncio.Queue()
+
+
+async def add_user_to_room(user, room, client=None):
+    await add_user_to_room_script(
+        keys=[core.rooms_key(), core.room_key(room), core.session_key(user), core.room_occupancy_key()],
+        args=[user, room, core.SERVER_ID],
+        client=client
+    )
+
+
+async def remove_user_from_room(user, room, client=None):
+    await remove_room_if_empty_script(
+        keys=[core.room_key(room), core.rooms_key(), core.room_occupancy_key()],
+        args=[room, user, "1" if room == core.MAIN_ROOM else "0"],
+        client=client
+    )
+
+
+rooms_cache = {"expires": 0.0, "rooms": []}
+
+
+async def room_listing():
+    if time.monotonic() < rooms_cache["expires"]:
+        return rooms_cache["rooms"]
+    entries = await redis_client.zrange(core.room_occupancy_key(), 0, -1, withscores=True)
+    rooms_cache["rooms"] = sorted((r, int(count)) for r, count in entries)
+    rooms_cache["expires"] = time.monotonic() + core.ROOMS_CACHE_TTL_SECONDS
+    return rooms_cache["rooms"]
+
+
+async def publish_room_message(room, text, sender=None, record=False):
+    core.messages_published.inc()
+    if core.COALESCE_WINDOW_MS > 0:
+        # The coalescer only takes a short lock here; it publishes from its
+        # own thread.
+        core.coalescer.add(room, text, sender, record)
+        return
+    envelope = core.encode_envelope("room_message", room, text, sender)
+    if record and core.HISTORY_LENGTH > 0:
+        pipe = publish_client.pipeline(transaction=False)
+        core.publish_room(pipe, room, envelope)
+        core.append_history(pipe, room, [(sender, text)])
+        await pipe.execute()
+        return
+    await core.publish_room(publish_client, room, envelope)
+
+
+async def publish_notification(publisher, message):
+    if core.INBOX_LENGTH <= 0:
+        await publish_client.publish(
+            core.notify_key(publisher), core.encode_envelope("notify_message", publisher, message)
+        )
+        return
+    await publish_notification_script(**core.notification_script_args(publisher, message))
+
+
+async def restore_session_state(user):
+    pipe = redis_client.pipeline()
+    pipe.smembers(core.subscriptions_key(user))
+    pipe.lrange(core.inbox_key(user), 0, -1)
+    pipe.delete(core.inbox_key(user))
+    pipe.hmget(core.user_limits.key(user), "tokens", "updated")
+    saved_subscriptions, inbox, _, limit_state = await pipe.execute()
+    core.user_limits.restore(user, limit_state)
+    return set(saved_subscriptions), inbox
+
+
+async def set_active_user(user):
+    return await redis_client.set(
+        core.active_key(user), core.SERVER_ID, nx=True, ex=core.ACTIVE_TTL_SECONDS
+    )
+
+
+async def refresh_active_users(users):
+    users = list(users)
+    if not users:
+        return set()
+    chunks = core.heartbeat_chunks(users)
+    async with heartbeat_client.pipeline(transaction=False) as pipe:
+        for chunk in chunks:
+            await refresh_active_users_script(**core.refresh_script_args(chunk), client=pipe)
+        results = await pipe.execute()
+    return core.lost_users(chunks, results)
+
+
+async def release_active_user(user):
+    await release_active_user_script(**core.release_script_args(user))
+
+
+async def sync_presence():
+    await prune_presence_script(**core.prune_script_args())
+    if core.presence_cache.stale():
+        core.presence_cache.load(
+            await heartbeat_client.zrangebyscore(core.presence_key(), time.time(), "+inf")
+        )
+
+
+async def reap_node(server_id):
+    total = 0
+    while True:
+        reaped, remaining = await reap_node_script(**core.reap_script_args(server_id))
+        total += reaped
+        if not remaining:
+            return total
+
+
+async def reap_dead_nodes():
+    for server_id in await heartbeat_client.zrangebyscore(core.nodes_key(), "-inf", time.time()):
+        if server_id == core.SERVER_ID or await heartbeat_client.exists(core.node_key(server_id)):
+            continue
+        reaped = await reap_node(server_id)
+        print(f"Reaped {reaped} sessions of dead server {server_id}")
+
+
+def watch_channel(channel):
+    channel_changes.append(("subscribe", channel))
+
+
+def unwatch_channel(channel):
+    channel_changes.append(("unsubscribe", channel))
+
+
+def add_room_session(room, session):
+    members = room_sessions.get(room)
+    if members is None:
+        members = room_sessions[room] = set()
+        watch_channel(core.room_channel(room))
+    members.add(session)
+
+
+def discard_room_session(room, session):
+    members = room_sessions.get(room)
+    if members is None:
+        return
+    members.discard(session)
+    if room != core.MAIN_ROOM and not members:
+        room_sessions.pop(room, None)
+        unwatch_channel(core.room_channel(room))
+
+
+def add_subscriber(publisher, session):
+    followers = subscribers.get(publisher)
+    if followers is None:
+        followers = subscribers[publisher] = set()
+        watch_channel(core.notify_key(publisher))
+    followers.add(session)
+    subscriber_snapshots.pop(publisher, None)
+
+
+def discard_subscriber(publisher, session):
+    followers = subscribers.get(publisher)
+    if followers is None:
+        return
+    followers.discard(session)
+    subscriber_snapshots.pop(publisher, None)
+    if not followers:
+        subscribers.pop(publisher, None)
+        unwatch_channel(core.notify_key(publisher))
+
+
+def enqueue(session, data):
+    queue = session.outbound
+    if queue is None:
+        return
+    if queue.full():
+        session.dropped += 1
+        if core.BACKPRESSURE_POLICY == "disconnect":
+            session.conn.transport.abort()
+            return
+        if core.BACKPRESSURE_POLICY != "drop_oldest":
+            # "block" would stall the event loop; drop the newest instead.
+            return
+        queue.get_nowait()
+    queue.put_nowait(data)
+
+
+def send_line(session, text):
+    enqueue(session, text.encode())
+
+
+async def timed_drain(conn):
+    # write() only buffers; drain() is where a slow client makes us wait.
+    start = time.perf_counter()
+    await conn.drain()
+    core.send_seconds.observe(time.perf_counter() - start)
+
+
+async def connection_writer(conn, queue):
+    try:
+        while True:
+            data = await queue.get()
+            if data is None:
+                break
+            if core.COALESCE_WINDOW_MS > 0:
+                # One write, so one TLS record, for everything queued.
+                batch = [data]
+                size = len(data)
+                while not queue.empty() and size < core.COALESCE_MAX_BYTES:
+                    data = queue.get_nowait()
+                    if data is None:
+                        conn.write(b"".join(batch))
+                        return
+                    batch.append(data)
+                    size += len(data)
+                conn.write(b"".join(batch))
+                await timed_drain(conn)
+                continue
+            conn.write(data)
+            while not queue.empty():
+                data = queue.get_nowait()
+                if data is None:
+                    return
+                conn.write(data)
+            await timed_drain(conn)
+    except Exception:
+        pass
+
+
+def deliver_to_local(room, data, sender=None, origin=None):
+    skip_sender = sender and origin == core.SERVER_ID
+    for session in tuple(room_sessions.get(room, ())):
+        if skip_sender and session.user == sender:
+            continue
+        enqueue(session, data)
+
+
+def deliver_batch_to_local(room, messages, origin=None):
+    data, own = core.batch_payloads(messages, origin)
+    for session in tuple(room_sessions.get(room, ())):
+        payload = own.get(session.user, data) if own else data
+        if payload:
+            enqueue(session, payload)
+
+
+def deliver_notification_to_local(publisher, message):
+    followers = subscriber_snapshots.get(publisher)
+    if followers is None and publisher in subscribers:
+        followers = subscriber_snapshots[publisher] = tuple(subscribers[publisher])
+    if not followers:
+        return
+    data = memoryview(f"Notification from {publisher}: ".encode() + message + b"\n")
+    notification_deliveries.put_nowait((followers, data))
+
+
+async def notification_delivery():
+    """See server.start_notification_delivery; yields to the loop between
+    chunks."""
+    chunk = max(core.FANOUT_CHUNK_SIZE, 1)
+    while True:
+        followers, data = await notification_deliveries.get()
+        for start in range(0, len(followers), chunk):
+            for session in followers[start:start + chunk]:
+                enqueue(session, data)
+            await asyncio.sleep(0)
+
+
+async def apply_channel_changes(pubsub):
+    pending = {channel: action for action, channel in channel_changes}
+    channel_changes.clear()
+
+    to_subscribe = [c for c, action in pending.items() if action == "subscribe"]
+    to_unsubscribe = [c for c, action in pending.items() if action == "unsubscribe"]
+    if to_subscribe:
+        await pubsub.subscribe(*to_subscribe)
+    if to_unsubscribe:
+        await pubsub.unsubscribe(*to_unsubscribe)
+
+
+async def start_pubsub_listener():
+    pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(core.room_channel(core.MAIN_ROOM), core.presence_channel())
+    presence = core.presence_channel().encode()
+    while True:
+        await apply_channel_changes(pubsub)
+        message = await pubsub.get_message(timeout=core.PUBSUB_POLL_SECONDS)
+        if not message or message.get("type") != "message":
+            continue
+        data = message.get("data")
+        if not data:
+            continue
+        if message.get("channel") == presence:
+            core.presence_cache.apply(data.decode())
+            continue
+        envelope = core.decode_envelope(data)
+        if envelope is None:
+            continue
+        payload_type, target, sender, origin, sent_at, body = envelope
+        if payload_type == "room_message":
+            deliver_to_local(target, body, sender, origin)
+        elif payload_type == "room_batch":
+            deliver_batch_to_local(target, body, origin)
+        elif payload_type == "notify_message":
+            deliver_notification_to_local(target, body)
+        core.observe_delivery(payload_type, sent_at)
+
+
+async def start_heartbeat():
+    while True:
+        try:
+            lost = await refresh_active_users([s.user for s in sessions if s.leased])
+            for session in sessions:
+                if session.user in lost:
+                    session.leased = False
+        except Exception as e:
+            print(f"Heartbeat error: {e}")
+        try:
+            await core.refresh_node(heartbeat_client).execute()
+            await sync_presence()
+            await reap_dead_nodes()
+        except Exception as e:
+            print(f"Presence sync error: {e}")
+        await asyncio.sleep(core.HEARTBEAT_INTERVAL_SECONDS)
+
+
+async def send_to_room(room, text, skip_session=None, record=False):
+    sender = skip_session.user if skip_session is not None else None
+    await publish_room_message(room, text, sender, record)
+
+
+async def move_user(session, target_room):
+    user = session.user
+    current_room = session.room
+    discard_room_session(current_room, session)
+    add_room_session(target_room, session)
+    session.room = target_room
+
+    pipe = redis_client.pipeline(transaction=False)
+    await remove_user_from_room(user, current_room, pipe)
+    await add_user_to_room(user, target_room, pipe)
+    if core.history_enabled():
+        pipe.xrevrange(core.history_key(target_room), count=core.HISTORY_BACKFILL)
+    results = await pipe.execute()
+    return core.history_lines(results[2]) if core.history_enabled() else []
+
+
+async def rate_limited(session, level, take):
+    """See server.rate_limited."""
+    wait = take()
+    if not wait:
+        return False
+    core.rate_limited_lines.inc(label_value=level)
+    session.limited += 1
+    if core.RATE_LIMIT_POLICY == "throttle":
+        # The read loop waits on this, so the stream stops reading and TCP
+        # pushes back on the client.
+        while wait:
+            await asyncio.sleep(min(wait, core.RATE_LIMIT_SYNC_SECONDS))
+            wait = take()
+        return False
+    if core.RATE_LIMIT_POLICY == "disconnect":
+        session.conn.transport.abort()
+        return True
+    send_line(session, f"Rate limit exceeded ({level}), message dropped\n")
+    return True
+
+
+async def process_input(session, command):
+    user = session.user
+    if (await rate_limited(session, "connection", lambda: core.connection_take(session))
+            or await rate_limited(session, "user", lambda: core.user_limits.take(user))):
+        return
+    try:
+        if command.startswith("/join "):
+            new_room = command.split(maxsplit=1)[1]
+            old_room = session.room
+
+            history = await move_user(session, new_room)
+
+            send_line(session, f"Joined room {new_room}\n")
+            if history:
+                send_line(session, core.format_history(new_room, history))
+            await send_to_room(old_room, f"{user} left {old_room}\n")
+            await send_to_room(new_room, f"{user} joined {new_room}\n", session)
+
+        elif command == "/leave":
+            old_room = session.room
+
+            history = await move_user(session, core.MAIN_ROOM)
+
+            send_line(session, f"Returned to {core.MAIN_ROOM}\n")
+            if history:
+                send_line(session, core.format_history(core.MAIN_ROOM, history))
+            await send_to_room(old_room, f"{user} left {old_room}\n")
+            await send_to_room(core.MAIN_ROOM, f"{user} joined {core.MAIN_ROOM}\n", session)
+
+        elif command == "/rooms" or command.startswith("/rooms "):
+            rooms = await room_listing()
+            send_line(session, core.format_room_listing(rooms, command[len("/rooms"):]))
+
+        elif command == "/users" or command.startswith("/users "):
+            send_line(session, core.format_user_listing(command[len("/users"):]))
+
+        elif command.startswith("/subscribe"):
+            user_to_subscribe = command.split(maxsplit=1)[1]
+            if not await redis_client.exists(core.credentials_key(user_to_subscribe)):
+                send_line(session, "User does not exist\n")
+                return
+            add_subscriber(user_to_subscribe, session)
+            session.subscriptions.add(user_to_subscribe)
+            await redis_client.sadd(core.subscriptions_key(user), user_to_subscribe)
+            await redis_client.sadd(core.subscribers_key(user_to_subscribe), user)
+            send_line(session, f"Subscribed to {user_to_subscribe}\n")
+
+        elif command.startswith("/unsubscribe"):
+            user_to_unsubscribe = command.split(maxsplit=1)[1]
+            if not await redis_client.exists(core.credentials_key(user_to_unsubscribe)):
+                send_line(session, "User does not exist\n")
+                return
+            discard_subscriber(user_to_unsubscribe, session)
+            session.subscriptions.discard(user_to_unsubscribe)
+            await redis_client.srem(core.subscriptions_key(user), user_to_unsubscribe)
+            await redis_client.srem(core.subscribers_key(user_to_unsubscribe), user)
+            send_line(session, f"Unsubscribed from {user_to_unsubscribe}\n")
+
+        elif command.startswith("/publish"):
+            message = command.split(maxsplit=1)[1]
+            await publish_notification(user, message)
+
+        elif command == "/drain":
+            if user not in core.ADMIN_USERS:
+                send_line(session, "Not allowed\n")
+                return
+            send_line(session, f"Draining server {core.SERVER_ID}\n")
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        elif command == "/stats":
+            send_line(
+                session,
+                f"Outbound queue: depth={session.outbound.qsize()} "
+                f"dropped={session.dropped} policy={core.BACKPRESSURE_POLICY}\n"
+            )
+            stats = core.admission.stats()
+            send_line(
+                session,
+                f"Admission: accepted={stats['accepted']} deferred={stats['deferred']} "
+                f"rejected={stats['rejected']}\n"
+            )
+            send_line(session, core.format_pool_stats(pool_meters.values()))
+            send_line(session, f"Rate limited: {session.limited} lines, policy={core.RATE_LIMIT_POLICY}\n")
+        else:
+            room = session.room
+            if await rate_limited(session, "room", lambda: core.room_limits.take(room)):
+                return
+            await send_to_room(room, f"{user}: {command}\n", session, record=True)
+
+    except Exception as e:
+        print(f"Error processing command from {user}: {e}")
+        send_line(session, "Error processing command\n")
+
+
+async def verify_credentials(user, client_hash):
+    start = time.perf_counter()
+    verified = await check_credentials(user, client_hash)
+    core.auth_seconds.observe(time.perf_counter() - start, "ok" if verified else "failed")
+    return verified
+
+
+async def check_credentials(user, client_hash):
+    stored_hash = await redis_client.get(core.credentials_key(user))
+    if stored_hash is None:
+        return False
+    key = core.verification_cache.key(user, client_hash, stored_hash)
+    if core.verification_cache.get(key):
+        return True
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(core.auth_pool, core.check_password, client_hash, stored_hash):
+        return False
+    core.verification_cache.add(key)
+    return True
+
+
+async def reject(conn, text):
+    conn.write(text.encode())
+    try:
+        await conn.drain()
+    except Exception:
+        pass
+    return False, "", None
+
+
+async def read_line(reader):
+    """reader.readline(), except that a line longer than READ_LIMIT is
+    skipped through its newline, as framing.LineFramer does, and comes back
+    once as framing.OVERFLOW. readline() would only drop what was buffered
+    and parse the rest of the line as new lines."""
+    try:
+        return await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        consumed = e.consumed
+    while True:
+        await reader.readexactly(consumed)
+        try:
+            await reader.readuntil(b"\n")
+            return framing.OVERFLOW
+        except asyncio.IncompleteReadError:
+            return framing.OVERFLOW
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+
+
+async def authenticate(reader, conn):
+    """Returns (logged_in, user, room); room is set for a resumed session."""
+    line = await reader.readline()
+    if not line:
+        return False, "", None
+    try:
+        parts = line.decode().strip().split(maxsplit=2)
+
+        if len(parts) == 3 and parts[0] == "RESUME":
+            return await resume(conn, parts[1], parts[2])
+
+        if len(parts) != 3 or parts[0] != "LOGIN":
+            return await reject(conn, "Invalid login request\n")
+
+        _, user, client_hash = parts
+
+        if not core.admission.admit():
+            return await reject(conn, core.admission.busy_message())
+        try:
+            verified = await verify_credentials(user, client_hash)
+        finally:
+            core.admission.release()
+
+        if not verified:
+            return await reject(conn, "Authentication failed\n")
+
+        if not await set_active_user(user):
+            return await reject(conn, "User already active\n")
+
+        conn.write(f"Login successful. Room: {core.MAIN_ROOM}\n".encode())
+        await conn.drain()
+        return True, user, None
+
+    except Exception as e:
+        print(f"Authentication error: {e}")
+        return await reject(conn, "Authentication failed\n")
+
+
+async def resume(conn, user, token):
+    """See server.resume."""
+    room = await resume_session_script(**core.resume_script_args(user, token))
+    if room is None:
+        core.resumes.inc(label_value="rejected")
+        return await reject(conn, "Resume failed\n")
+    core.resumes.inc(label_value="resumed")
+    conn.write(f"Resume successful. Room: {room}\n".encode())
+    await conn.drain()
+    return True, user, room
+
+
+async def tls_handshake(conn, ssl_context):
+    """Admission control, then TLS. The loop accepts eagerly, so connections
+    over the accept rate wait here instead of in the listen backlog."""
+    wait = core.admission.reserve(max_wait=HANDSHAKE_TIMEOUT_SECONDS)
+    if wait:
+        await asyncio.sleep(wait)
+    if wait is None or not core.admission.admit():
+        # Plain text before TLS; see server.tls_handshake.
+        await reject(conn, core.admission.busy_message())
+        return False
+    try:
+        await conn.start_tls(ssl_context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT_SECONDS)
+    except (OSError, ssl.SSLError, asyncio.TimeoutError):
+        return False
+    finally:
+        core.admission.release()
+    core.admission.record_accepted()
+    return True
+
+
+def detach_session(session):
+    """Stop delivering to a finished session and return its room; see
+    server.detach_session."""
+    room = session.room
+    discard_room_session(room, session)
+    for publisher in session.subscriptions:
+        discard_subscriber(publisher, session)
+    session.leased = False
+    return room
+
+
+async def client_session(reader, conn, ssl_context):
+    addr = conn.get_extra_info("peername")
+    session = None
+    writer_task = None
+
+    if not await tls_handshake(conn, ssl_context):
+        conn.close()
+        return
+
+    try:
+        logged_in, username, resumed_room = await authenticate(reader, conn)
+        if not logged_in:
+            return
+
+        queue = asyncio.Queue(core.OUTBOUND_QUEUE_SIZE)
+        writer_task = asyncio.create_task(connection_writer(conn, queue))
+        session = Session(conn, username, queue, reader)
+        session.room = resumed_room or core.MAIN_ROOM
+        sessions.add(session)
+        add_room_session(session.room, session)
+
+        saved_subscriptions, inbox = await restore_session_state(username)
+        session.subscriptions = saved_subscriptions
+        for subscribed_user in saved_subscriptions:
+            add_subscriber(subscribed_user, session)
+        if inbox:
+            send_line(session, core.format_inbox(inbox))
+
+        await add_user_to_room(username, session.room)
+        await core.register_session(username, redis_client).execute()
+
+        if resumed_room is None:
+            await send_to_room(core.MAIN_ROOM, f"{username} joined the lobby\n", session)
+
+        while True:
+            line = await read_line(reader)
+            if line is framing.OVERFLOW:
+                send_line(session, "Line too long\n")
+                continue
+            if not line:
+                break
+            await process_input(session, line.decode().strip())
+
+    except Exception as e:
+        print(f"Client error {addr}: {e}")
+
+    finally:
+        if session is not None:
+            room = detach_session(session)
+            try:
+                if session.resume_token:
+                    pipe = core.hand_off_session(session.user, room, session.resume_token, redis_client)
+                    await remove_user_from_room(session.user, room, pipe)
+                    await release_active_user_script(**core.release_script_args(session.user), client=pipe)
+                    await pipe.execute()
+                    core.resumes.inc(label_value="handed_off")
+                else:
+                    await remove_user_from_room(session.user, room)
+                    await core.unregister_session(session.user, redis_client).execute()
+                    await release_active_user(session.user)
+
+                    await send_to_room(room, f"{session.user} disconnected\n")
+            except Exception as e:
+                print(f"Cleanup error for {session.user}: {e}")
+
+            queue, session.outbound = session.outbound, None
+            # The sentinel may not fit if the queue is full; cancel instead.
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                writer_task.cancel()
+        if writer_task is not None:
+            try:
+                await writer_task
+            except asyncio.CancelledError:
+                pass
+        if session is not None and session.resume_token:
+            # After the writer's last write and the Redis hand-off; see
+            # server.client_session.
+            conn.write(core.reconnect_line(session.resume_token).encode())
+        conn.close()
+        if session is not None:
+            if session.resume_token:
+                # Let the line reach the client before the loop goes away.
+                try:
+                    await asyncio.wait_for(conn.wait_closed(), 1)
+                except Exception:
+                    pass
+            sessions.discard(session)
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def serve():
+
+    ssl_context = core.create_ssl_context()
+    server = await asyncio.start_server(
+        lambda reader, conn: client_session(reader, conn, ssl_context),
+        core.SERVER_HOST,
+        core.SERVER_PORT,
+        reuse_address=True,
+        reuse_port=core.SERVER_REUSE_PORT or None,
+        backlog=LISTEN_BACKLOG,
+        limit=READ_LIMIT
+    )
+
+    # The loop only keeps weak references to tasks; these are held here
+    # until shutdown.
+    background = [
+        asyncio.create_task(start_pubsub_listener()),
+        asyncio.create_task(start_heartbeat()),
+        asyncio.create_task(notification_delivery())
+    ]
+    # Syncs through the threaded engine's Redis client, like the coalescer.
+    threading.Thread(target=core.start_rate_limit_sync, daemon=True).start()
+    if core.COALESCE_WINDOW_MS > 0:
+        threading.Thread(target=core.coalescer.run, daemon=True).start()
+
+    print(f"Chat server running on {core.SERVER_HOST}:{core.SERVER_PORT} (TLS enabled, asyncio engine)")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    async with server:
+        await stop.wait()
+        # A second signal gets the default action and ends the process at once.
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+        server.close()
+        print(f"Draining {len(sessions)} connections")
+        await drain_sessions(core.DRAIN_TIMEOUT_SECONDS)
+    for task in background:
+        task.cancel()
+
+
+async def drain_sessions(timeout):
+    """Hand every session off (close it, with RESUME_TTL_SECONDS=0) and wait
+    until they have left their rooms and released their leases."""
+    for session in list(sessions):
+        if core.RESUME_TTL_SECONDS > 0:
+            session.resume_token = secrets.token_hex(16)
+            # Ends the session's read loop; the transport stays up for the
+            # RECONNECT line.
+            session.conn.transport.pause_reading()
+            session.reader.feed_eof()
+        else:
+            # close() would wait for the client's TLS close_notify.
+            session.conn.transport.abort()
+    deadline = time.monotonic() + timeout
+    while sessions and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+def start_server():
+    raise_nofile_limit()
+
+    core.load_scripts()
+    core.register_default_users()
+    core.start_metrics(
+        lambda: len(sessions),
+        lambda: len(room_sessions),
+        lambda: [s.outbound.qsize() for s in list(sessions) if s.outbound is not None],
+        pool_meters.values(),
+    )
+    core.init_room_index()
+    core.reap_node(core.SERVER_ID)
+    core.refresh_node().execute()
+
+    asyncio.run(serve())
+    core.retire_node()
+
+
+if __name__ == "__main__":
+    start_server()
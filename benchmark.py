@@ -0,0 +1,1011 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the chat server.
+
+Usage: python benchmark.py engines [--connections 5000] [--messages 500]
+       python benchmark.py fanout [--members 1000] [--messages 2000]
+       python benchmark.py contention [--rooms 200] [--threads 32]
+       python benchmark.py heartbeat [--sessions 1000 5000 20000]
+       python benchmark.py loginstorm [--users 200] [--rounds 3] [--engine threaded]
+       python benchmark.py handshake [--handshakes 200]
+       python benchmark.py framing [--burst-mb 1]
+       python benchmark.py coalesce [--senders 4] [--messages 2000] [--window-ms 5]
+       python benchmark.py inbox [--followers 100 1000 10000] [--online 0.5]
+       python benchmark.py metrics [--calls 1000000] [--threads 8]
+       python benchmark.py sessions [--sessions 10000 100000] [--follows 5]
+       python benchmark.py follows [--subscriptions 1000 10000] [--followers 10 1000 10000]
+
+engines: starts server.py once per connection engine (threaded, asyncio)
+         against the Redis configured by REDIS_HOST/REDIS_PORT, opens N idle
+         TLS connections to measure server RSS per connection, then measures
+         p50/p99 lobby broadcast latency between the default users a-h.
+fanout:  in-process microbenchmark of one node delivering room messages to
+         a room of N local members: per-recipient encode vs encode-once, and
+         JSON vs binary pub/sub envelope decoding. Needs no Redis.
+contention: in-process; many threads deliver to and move members between
+         many rooms, once with a single lock stripe (the old global lock)
+         and once with LOCK_STRIPES stripes. Reports throughput and the time
+         spent waiting for room locks. Needs no Redis.
+heartbeat: heartbeat tick time for N local sessions, one refresh round-trip
+         per user versus the batched refresh, against REDIS_HOST/REDIS_PORT.
+loginstorm: registers N users, starts server.py and has all of them log in
+         at once, several rounds in a row. The first round runs against a
+         cold verification cache (like a reconnect storm onto a freshly
+         started node), the later ones against a warm one. Reports
+         logins/second.
+handshake: in-process TLS server on loopback; full versus resumed (session
+         ticket) handshakes, with the RSA cert.pem/key.pem and with a freshly
+         generated ECDSA P-256 certificate. Reports client latency and
+         server CPU per handshake. Needs no Redis.
+framing: in-process; parses 1 MB bursts of short lines, long lines and a
+         single oversized paste, with the old recv(1024)/str.split loop and
+         with framing.LineFramer. Needs no Redis.
+coalesce: starts server.py with coalescing off and then on; the default
+         users a-h sit in the lobby while some of them flood it. Reports
+         delivered messages/second, server write syscalls (/proc/<pid>/io
+         syscw, which counts the threaded engine's TLS writes but not the
+         send(2) calls of the asyncio engine) and Redis PUBLISH calls,
+         against REDIS_HOST/REDIS_PORT.
+inbox:   /publish cost for a publisher with N followers, a fraction of them
+         online: plain PUBLISH (no inbox) versus the fan-out script that
+         fills offline followers' inboxes; plus the login-time drain of a
+         full inbox. Against REDIS_HOST/REDIS_PORT.
+metrics: in-process; cost per call of counter and histogram recording and
+         of a TimedLock, single-threaded and with all threads on one
+         histogram. Needs no Redis.
+sessions: in-process; N simulated sessions spread over rooms, each with
+         some subscriptions, kept in the old parallel dicts and in
+         server.Session objects. Reports traced memory per session
+         (excluding sockets and writers) and teardown time per session.
+         Needs no Redis.
+follows: in-process; attaching and detaching a session with N
+         subscriptions, one subscriber lock per publisher versus one per
+         lock stripe, and how long the pub/sub listener is busy with one
+         notification for N local followers, copying the follower set
+         inline versus the cached snapshot and delivery thread hand-off.
+         Needs no Redis.
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import resource
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+import time
+import random
+
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+HOST = "127.0.0.1"
+SHARED_SALT = b"$2b$12$abcdefghijklmnopqrstuu"
+DEFAULT_USERS = "abcdefgh"
+
+
+@functools.lru_cache(maxsize=None)
+def client_hash(pwd="1"):
+    return bcrypt.hashpw(pwd.encode(), SHARED_SALT).decode()
+
+
+def client_ssl_context():
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def process_write_syscalls(pid):
+    with open(f"/proc/{pid}/io") as f:
+        for line in f:
+            if line.startswith("syscw:"):
+                return int(line.split()[1])
+    return 0
+
+
+def process_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def start_server_process(engine, port, extra_env=None):
+    env = dict(os.environ)
+    env.update({
+        "SERVER_ENGINE": engine,
+        "SERVER_PORT": str(port),
+        "SERVER_ID": f"bench-{engine}-{port}",
+        # The flood limits would cap every benchmark at a few lines per
+        # second per user; extra_env turns them back on where wanted.
+        "RATE_LIMIT_CONNECTION_RATE": "0",
+        "RATE_LIMIT_USER_RATE": "0",
+        "RATE_LIMIT_ROOM_RATE": "0",
+        # One benchmark client opens connections far faster than a real
+        # population; admission control would turn most of them away.
+        "ACCEPT_RATE": "0",
+        "MAX_PENDING_LOGINS": "100000",
+    })
+    env.update(extra_env or {})
+    proc = subprocess.Popen(
+        [sys.executable, "server.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    ssl_context = client_ssl_context()
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            # Probe with a full handshake so the server is known to be
+            # serving TLS, not just listening.
+            sock = socket.create_connection((HOST, port), timeout=1)
+            ssl_context.wrap_socket(sock, server_hostname="localhost").close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start on port {port}")
+
+
+async def open_idle_connections(port, count, ssl_context, batch=200):
+    writers = []
+    for start in range(0, count, batch):
+        results = await asyncio.gather(*(
+            asyncio.open_connection(HOST, port, ssl=ssl_context, server_hostname="localhost")
+            for _ in range(min(batch, count - start))
+        ), return_exceptions=True)
+        writers.extend(r[1] for r in results if not isinstance(r, Exception))
+    return writers
+
+
+async def login(port, user, ssl_context):
+    reader, writer = await asyncio.open_connection(
+        HOST, port, ssl=ssl_context, server_hostname="localhost"
+    )
+    writer.write(f"LOGIN {user} {client_hash()}\n".encode())
+    await writer.drain()
+    response = await reader.readline()
+    if b"successful" not in response:
+        raise RuntimeError(f"login failed for {user}: {response!r}")
+    return reader, writer
+
+
+async def measure_broadcast(port, messages, ssl_context):
+    clients = [await login(port, u, ssl_context) for u in DEFAULT_USERS]
+    await asyncio.sleep(0.5)
+    sender_reader, sender = clients[0]
+    latencies = []
+
+    async def receive(reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            text = line.decode()
+            if "bench " not in text:
+                continue
+            _, seq, sent_at = text.rsplit(" ", 2)
+            latencies.append(time.perf_counter() - float(sent_at))
+            if int(seq) == messages - 1:
+                return
+
+    receivers = [asyncio.create_task(receive(r)) for r, _ in clients[1:]]
+    for seq in range(messages):
+        sender.write(f"bench {seq} {time.perf_counter()}\n".encode())
+        await sender.drain()
+        await asyncio.sleep(0.002)
+    try:
+        await asyncio.wait_for(asyncio.gather(*receivers), timeout=30)
+    except asyncio.TimeoutError:
+        for task in receivers:
+            task.cancel()
+
+    for _, writer in clients:
+        writer.close()
+    return latencies
+
+
+async def bench_engine(engine, port, connections, messages):
+    ssl_context = client_ssl_context()
+    proc = start_server_process(engine, port)
+    try:
+        await asyncio.sleep(1)
+        rss_before = process_rss_kb(proc.pid)
+        idle = await open_idle_connections(port, connections, ssl_context)
+        await asyncio.sleep(2)
+        rss_after = process_rss_kb(proc.pid)
+
+        latencies = await measure_broadcast(port, messages, ssl_context)
+
+        for writer in idle:
+            writer.close()
+        await asyncio.sleep(1)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    per_conn = (rss_after - rss_before) / max(1, len(idle))
+    print(f"{engine:>9}: {len(idle)}/{connections} idle connections, "
+          f"{per_conn:.1f} KiB RSS/connection, "
+          f"broadcast p50={percentile(latencies, 50) * 1000:.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.2f}ms "
+          f"({len(latencies)} deliveries)")
+
+
+def run_engines(args):
+    raise_nofile_limit()
+    for offset, engine in enumerate(("threaded", "asyncio")):
+        asyncio.run(bench_engine(engine, args.port + offset, args.connections, args.messages))
+
+
+class NullWriter:
+    """Stands in for OutboundQueue; keeps the last buffer it was given."""
+
+    def __init__(self):
+        self.last = None
+
+    def put(self, data, deadline=None):
+        self.last = data
+
+    def close(self):
+        pass
+
+
+def time_per_call(fn, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count
+
+
+def run_fanout(args):
+    import server
+
+    room = "bench"
+    server.room_sessions[room] = {
+        server.Session(object(), f"member{i}", NullWriter()) for i in range(args.members)
+    }
+
+    text = "sender: " + "x" * args.size + "\n"
+
+    # The pre-queue deliver_to_local loop, with sendall() replaced by put().
+    global_lock = threading.Lock()
+
+    def per_recipient_encode():
+        with global_lock:
+            for session in server.room_sessions[room].copy():
+                if session.user == "sender":
+                    continue
+                session.outbound.put(text.encode())
+
+    def encode_once():
+        server.deliver_to_local(room, memoryview(text.encode()), "sender", "elsewhere")
+
+    envelopes = {}
+    for fmt in ("json", "binary"):
+        server.ENVELOPE_FORMAT = fmt
+        envelope = server.encode_envelope("room_message", room, text, "sender")
+        envelopes[fmt] = envelope if isinstance(envelope, bytes) else envelope.encode()
+
+    print(f"room of {args.members} members, {len(text)} byte message, {args.messages} messages")
+    baseline = time_per_call(per_recipient_encode, args.messages)
+    shared = time_per_call(encode_once, args.messages)
+    print(f"  per-recipient encode: {baseline * 1e6:9.1f} us/message")
+    print(f"  encode once (shared): {shared * 1e6:9.1f} us/message  ({baseline / shared:.2f}x)")
+    for fmt, envelope in envelopes.items():
+        decode = time_per_call(lambda: server.decode_envelope(envelope), args.messages * 10)
+        print(f"  {fmt:>6} envelope: {len(envelope):6d} bytes, decode {decode * 1e6:6.2f} us")
+
+
+class CountingLock:
+    """Wraps a lock and counts acquisitions that found it already held."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=False):
+            self.contended += 1
+            self.lock.acquire()
+        self.acquired += 1
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+def contention_round(server, stripes, args):
+    server.room_locks = [CountingLock() for _ in range(stripes)]
+    server.room_sessions.clear()
+    rooms = [f"room{i}" for i in range(args.rooms)]
+    members = {}
+    for room in rooms:
+        server.room_sessions[room] = set()
+        for i in range(args.members):
+            session = server.Session(object(), f"member{i}", NullWriter())
+            server.room_sessions[room].add(session)
+            members.setdefault(room, []).append(session)
+
+    data = memoryview(b"sender: hello\n")
+    operations = [0] * args.threads
+    stop = time.perf_counter() + args.seconds
+
+    def worker(index):
+        rng = random.Random(index)
+        done = 0
+        while time.perf_counter() < stop:
+            room = rng.choice(rooms)
+            if rng.random() < args.move_ratio:
+                target = rng.choice(rooms)
+                session = members[room][0]
+                with server.room_lock(room):
+                    server.room_sessions[room].discard(session)
+                with server.room_lock(target):
+                    server.room_sessions[target].add(session)
+                with server.room_lock(target):
+                    server.room_sessions[target].discard(session)
+                with server.room_lock(room):
+                    server.room_sessions[room].add(session)
+            else:
+                server.deliver_to_local(room, data)
+            done += 1
+        operations[index] = done
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    total = sum(operations)
+    acquired = sum(lock.acquired for lock in server.room_locks)
+    contended = sum(lock.contended for lock in server.room_locks)
+    print(f"  {stripes:4d} stripe(s): {total / args.seconds:10.0f} ops/s, "
+          f"{contended / max(1, acquired):6.2%} of lock acquisitions contended")
+
+
+def run_contention(args):
+    import server
+
+    print(f"{args.rooms} rooms x {args.members} members, {args.threads} threads, "
+          f"{args.move_ratio:.0%} moves")
+    for stripes in (1, server.LOCK_STRIPES):
+        contention_round(server, stripes, args)
+
+
+def run_heartbeat(args):
+    import server
+
+    for count in args.sessions:
+        users = [f"bench_hb_{i}" for i in range(count)]
+        pipe = server.redis_client.pipeline(transaction=False)
+        for user in users:
+            pipe.set(server.active_key(user), server.SERVER_ID, ex=server.ACTIVE_TTL_SECONDS)
+        pipe.execute()
+
+        per_user = 0.0
+        if count <= args.max_per_user:
+            started = time.perf_counter()
+            for user in users:
+                server.refresh_active_users([user])
+            per_user = time.perf_counter() - started
+
+        started = time.perf_counter()
+        lost = server.refresh_active_users(users)
+        batched = time.perf_counter() - started
+
+        server.redis_client.delete(*(server.active_key(u) for u in users))
+        server.redis_client.zrem(server.presence_key(), *users)
+        per_user_text = f"{per_user * 1000:9.1f} ms" if per_user else "  skipped   "
+        print(f"{count:7d} sessions: per-user {per_user_text}, "
+              f"batched {batched * 1000:8.1f} ms ({len(lost)} lost)")
+
+
+async def login_round(port, users, concurrency):
+    ssl_context = client_ssl_context()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def attempt(user):
+        async with slots:
+            try:
+                return await login(port, user, ssl_context)
+            except Exception:
+                return None
+
+    started = time.perf_counter()
+    sessions = await asyncio.gather(*(attempt(u) for u in users))
+    elapsed = time.perf_counter() - started
+    for session in sessions:
+        if session is not None:
+            session[1].close()
+    return elapsed, sum(1 for session in sessions if session is not None)
+
+
+def run_loginstorm(args):
+    import server
+
+    raise_nofile_limit()
+    users = [f"bench_login_{i}" for i in range(args.users)]
+    missing = [u for u in users if not server.user_exists(u)]
+    if missing:
+        print(f"registering {len(missing)} users...")
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as pool:
+            list(pool.map(lambda u: server.register_user(u, "1"), missing))
+
+    proc = start_server_process(args.engine, args.port)
+    try:
+        for n in range(args.rounds):
+            elapsed, ok = asyncio.run(login_round(args.port, users, args.concurrency))
+            cache = "cold" if n == 0 else "warm"
+            print(f"round {n + 1} ({cache} cache): {ok}/{len(users)} logins in "
+                  f"{elapsed:.2f}s = {ok / elapsed:.1f} logins/s")
+            # Let the server release the sessions before the next round.
+            time.sleep(1)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def handshake_server(listener, ssl_context, cpu_times):
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+        started = time.thread_time()
+        try:
+            conn = ssl_context.wrap_socket(sock, server_side=True)
+            # TLS 1.3 tickets are sent after the handshake; the client reads
+            # this byte, by which point its session is resumable.
+            conn.sendall(b"x")
+            cpu_times.append(time.thread_time() - started)
+            conn.close()
+        except OSError:
+            sock.close()
+
+
+def handshake_round(certfile, keyfile, count, resume):
+    import server
+
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    ssl_context.num_tickets = server.TLS_SESSION_TICKETS
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((HOST, 0))
+    listener.listen(128)
+    cpu_times = []
+    threading.Thread(
+        target=handshake_server,
+        args=(listener, ssl_context, cpu_times),
+        daemon=True
+    ).start()
+
+    client_context = client_ssl_context()
+    session = None
+    latencies = []
+    resumed = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        sock = socket.create_connection(listener.getsockname())
+        conn = client_context.wrap_socket(sock, server_hostname="localhost", session=session)
+        conn.recv(1)
+        latencies.append(time.perf_counter() - started)
+        resumed += conn.session_reused
+        if resume:
+            session = conn.session
+        conn.close()
+    listener.close()
+    # The server thread records its CPU time after sending, so wait for the
+    # last sample.
+    time.sleep(0.1)
+    return latencies, cpu_times, resumed
+
+
+def run_handshake(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        ecdsa_cert = os.path.join(tmp, "cert.pem")
+        ecdsa_key = os.path.join(tmp, "key.pem")
+        env = dict(os.environ, CERT_KEY_TYPE="ecdsa", CERT_FILE=ecdsa_cert, KEY_FILE=ecdsa_key)
+        subprocess.run([sys.executable, "generate_certs.py"], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        certs = [
+            ("rsa", os.environ.get("CERT_FILE", "cert.pem"), os.environ.get("KEY_FILE", "key.pem")),
+            ("ecdsa", ecdsa_cert, ecdsa_key),
+        ]
+        print(f"{'cert':<6} {'mode':<8} {'resumed':>8} {'p50 ms':>8} {'p99 ms':>8} {'server cpu ms':>14}")
+        for name, certfile, keyfile in certs:
+            for resume in (False, True):
+                latencies, cpu_times, resumed = handshake_round(certfile, keyfile, args.handshakes, resume)
+                cpu = sum(cpu_times) / len(cpu_times) if cpu_times else 0.0
+                print(f"{name:<6} {'resumed' if resume else 'full':<8} {resumed:>8} "
+                      f"{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f} "
+                      f"{cpu * 1000:>14.2f}")
+
+
+class ChunkSocket:
+    """Replays a list of chunks through recv/recv_into, like a socket."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def recv(self, size):
+        return next(self.chunks, b"")
+
+    def recv_into(self, buffer):
+        chunk = next(self.chunks, b"")
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def split_lines_str(sock):
+    # The framing loop client_session used before framing.LineFramer.
+    buffer = ""
+    lines = 0
+    while True:
+        data = sock.recv(1024).decode()
+        if not data:
+            return lines
+        buffer += data
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            lines += 1
+
+
+def split_lines_framer(sock):
+    from framing import LineFramer, LineTooLong
+
+    framer = LineFramer()
+    lines = 0
+    while True:
+        try:
+            received = framer.read_lines(sock)
+        except LineTooLong:
+            lines += 1
+            continue
+        if received is None:
+            return lines
+        for line in received:
+            lines += 1
+
+
+def run_framing(args):
+    import framing
+
+    size = int(args.burst_mb * 1024 * 1024)
+    bursts = {
+        "short lines (20 B)": b"hello from a client\n",
+        "long lines (4 KiB)": b"x" * 4095 + b"\n",
+        "one oversized paste": b"y" * (size - 1) + b"\n",
+    }
+    print(f"{'burst':<22} {'parser':<22} {'chunk':>6} {'ms':>9} {'MB/s':>8}")
+    for name, pattern in bursts.items():
+        data = (pattern * (size // len(pattern) + 1))[:size]
+        for parser, fn, chunk_size in (
+            ("str split", split_lines_str, 1024),
+            ("LineFramer", split_lines_framer, 1024),
+            ("LineFramer", split_lines_framer, framing.READ_SIZE),
+        ):
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+            started = time.perf_counter()
+            fn(ChunkSocket(chunks))
+            elapsed = time.perf_counter() - started
+            print(f"{name:<22} {parser:<22} {chunk_size:>6} {elapsed * 1000:>9.2f} "
+                  f"{size / elapsed / 1e6:>8.1f}")
+
+
+async def flood_room(port, senders, messages, ssl_context):
+    clients = {u: await login(port, u, ssl_context) for u in DEFAULT_USERS}
+    await asyncio.sleep(0.5)
+    flooders = list(DEFAULT_USERS)[:senders]
+    received = {u: 0 for u in clients}
+
+    async def receive(user, reader):
+        expected = messages * (senders - (user in flooders))
+        while received[user] < expected:
+            line = await reader.readline()
+            if not line:
+                return
+            if b": flood " in line:
+                received[user] += 1
+
+    receivers = [asyncio.create_task(receive(u, r)) for u, (r, _) in clients.items()]
+    started = time.perf_counter()
+    for user in flooders:
+        writer = clients[user][1]
+        writer.write(b"".join(f"flood {seq}\n".encode() for seq in range(messages)))
+    for user in flooders:
+        await clients[user][1].drain()
+    try:
+        await asyncio.wait_for(asyncio.gather(*receivers), timeout=60)
+    except asyncio.TimeoutError:
+        for task in receivers:
+            task.cancel()
+    elapsed = time.perf_counter() - started
+
+    for _, writer in clients.values():
+        writer.close()
+    return sum(received.values()), elapsed
+
+
+def run_coalesce(args):
+    import server
+
+    ssl_context = client_ssl_context()
+    for window in (0, args.window_ms):
+        # A terminated server leaves its users' leases behind.
+        server.redis_client.delete(*(server.active_key(u) for u in DEFAULT_USERS))
+        proc = start_server_process(args.engine, args.port, {
+            "COALESCE_WINDOW_MS": str(window),
+            "COALESCE_MAX_BYTES": str(args.max_bytes),
+            # Measure throughput, not the drop policy.
+            "OUTBOUND_QUEUE_SIZE": "1000000",
+        })
+        try:
+            publishes_before = server.redis_client.info("commandstats").get("cmdstat_publish", {}).get("calls", 0)
+            syscalls_before = process_write_syscalls(proc.pid)
+            delivered, elapsed = asyncio.run(flood_room(args.port, args.senders, args.messages, ssl_context))
+            syscalls = process_write_syscalls(proc.pid) - syscalls_before
+            publishes = server.redis_client.info("commandstats").get("cmdstat_publish", {}).get("calls", 0) - publishes_before
+        finally:
+            proc.terminate()
+            proc.wait()
+        mode = f"coalesce {window:g} ms" if window else "no coalescing"
+        print(f"{mode:>18}: {delivered} deliveries in {elapsed:.2f}s = "
+              f"{delivered / elapsed:,.0f} msg/s, {syscalls or '-'} write syscalls, {publishes} publishes")
+
+
+def run_inbox(args):
+    import server
+
+    publisher = "bench_publisher"
+    for count in args.followers:
+        followers = [f"bench_follower_{i}" for i in range(count)]
+        online = followers[:int(count * args.online)]
+        pipe = server.redis_client.pipeline(transaction=False)
+        pipe.sadd(server.subscribers_key(publisher), *followers)
+        for user in online:
+            pipe.set(server.active_key(user), "bench", ex=300)
+        pipe.execute()
+
+        plain = time_per_call(
+            lambda: server.redis_client.publish(
+                server.notify_key(publisher),
+                server.encode_envelope("notify_message", publisher, "bench")
+            ),
+            args.publishes
+        )
+        fanout = time_per_call(lambda: server.publish_notification(publisher, "bench"), args.publishes)
+        drain = time_per_call(lambda: server.restore_session_state(followers[-1]), 1)
+
+        server.redis_client.delete(
+            server.subscribers_key(publisher),
+            *(server.active_key(u) for u in online),
+            *(server.inbox_key(u) for u in followers)
+        )
+        print(f"{count:6d} followers ({len(online)} online): publish {plain * 1000:7.3f} ms, "
+              f"publish + inbox fan-out {fanout * 1000:8.3f} ms, "
+              f"drain of {min(args.publishes, server.INBOX_LENGTH)} {drain * 1000:6.3f} ms")
+
+
+def run_metrics(args):
+    import metrics
+
+    histogram = metrics.Histogram("bench_seconds", "bench", "label")
+    counter = metrics.Counter("bench_total", "bench")
+    plain_lock = threading.Lock()
+    timed_lock = metrics.TimedLock(histogram, "lock")
+
+    def with_lock(lock):
+        with lock:
+            pass
+
+    def timed_observe():
+        start = time.perf_counter()
+        histogram.observe(time.perf_counter() - start, "x")
+
+    print(f"{'operation':<34} {'ns/call':>8}")
+    for name, fn in (
+        ("empty call", lambda: None),
+        ("Counter.inc", counter.inc),
+        ("perf_counter + Histogram.observe", timed_observe),
+        ("threading.Lock", lambda: with_lock(plain_lock)),
+        ("TimedLock (uncontended)", lambda: with_lock(timed_lock)),
+    ):
+        print(f"{name:<34} {time_per_call(fn, args.calls) * 1e9:>8.0f}")
+
+    # All threads on one histogram: the worst case for its lock.
+    per_thread = args.calls // args.threads
+    threads = [
+        threading.Thread(target=lambda: [timed_observe() for _ in range(per_thread)])
+        for _ in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    print(f"{f'observe, {args.threads} threads':<34} {elapsed / (per_thread * args.threads) * 1e9:>8.0f}")
+    started = time.perf_counter()
+    metrics.render()
+    print(f"render of {len(metrics.registry)} metrics: {(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+class DictLayout:
+    """Per-connection state as kept before server.Session: entries in
+    parallel dicts keyed by socket or user, updated the way the old
+    client_session did."""
+
+    def __init__(self, server):
+        self.server = server
+        self.connection_to_user = {}
+        self.user_location = {}
+        self.room_connections = {}
+        self.subscribers = {}
+        self.subscriptions = {}
+        self.active_users_local = set()
+        self.outbound = {}
+
+    def open(self, conn, user, room, follows):
+        server = self.server
+        with server.sessions_lock:
+            self.outbound[conn] = NullWriter()
+            self.connection_to_user[conn] = user
+            self.active_users_local.add(user)
+        self.user_location[user] = room
+        with server.room_lock(room):
+            self.room_connections.setdefault(room, set()).add(conn)
+        self.subscriptions[user] = set(follows)
+        for publisher in follows:
+            with server.subscriber_lock(publisher):
+                self.subscribers.setdefault(publisher, set()).add(conn)
+        return conn, user
+
+    def close(self, handle):
+        server = self.server
+        conn, user = handle
+        room = self.user_location.pop(user)
+        with server.room_lock(room):
+            conns = self.room_connections[room]
+            conns.discard(conn)
+            if not conns:
+                del self.room_connections[room]
+        for publisher in self.subscriptions.pop(user, set()):
+            with server.subscriber_lock(publisher):
+                conns = self.subscribers[publisher]
+                conns.discard(conn)
+                if not conns:
+                    del self.subscribers[publisher]
+        with server.sessions_lock:
+            self.connection_to_user.pop(conn, None)
+            self.active_users_local.discard(user)
+            writer = self.outbound.pop(conn, None)
+        writer.close()
+
+
+class SessionLayout:
+    """server.Session objects in the server's own indexes."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def open(self, conn, user, room, follows):
+        server = self.server
+        session = server.Session(conn, user, NullWriter())
+        with server.sessions_lock:
+            server.sessions.add(session)
+        session.room = room
+        with server.room_lock(room):
+            server.add_room_session(room, session)
+        server.add_subscriptions(session, follows)
+        return session
+
+    def close(self, session):
+        self.server.detach_session(session)
+        with self.server.sessions_lock:
+            self.server.sessions.discard(session)
+
+
+def run_sessions(args):
+    import server
+
+    # No pub/sub listener here to apply channel changes.
+    server.watch_channel = server.unwatch_channel = lambda channel: None
+    rng = random.Random(1)
+    for count in args.sessions:
+        users = [f"user{i}" for i in range(count)]
+        conns = [object() for _ in range(count)]
+        rooms = [f"room{rng.randrange(args.rooms)}" for _ in range(count)]
+        publishers = [f"user{i}" for i in range(min(count, args.publishers))]
+        follows = [rng.sample(publishers, args.follows) for _ in range(count)]
+        print(f"{count} sessions in {args.rooms} rooms, {args.follows} subscriptions each")
+
+        for name, layout in (("parallel dicts", DictLayout(server)), ("Session objects", SessionLayout(server))):
+            server.room_sessions.clear()
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            handles = [layout.open(*state) for state in zip(conns, users, rooms, follows)]
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+
+            started = time.perf_counter()
+            for handle in handles:
+                layout.close(handle)
+            teardown = (time.perf_counter() - started) / count
+            print(f"  {name:>15}: {used / count:6.0f} B/session, teardown {teardown * 1e6:5.2f} us/session")
+
+
+def run_follows(args):
+    import server
+
+    server.watch_channel = server.unwatch_channel = lambda channel: None
+
+    for count in args.subscriptions:
+        publishers = [f"publisher{i}" for i in range(count)]
+        session = server.Session(object(), "reader", NullWriter())
+
+        # The old client_session / detach_session loops.
+        def per_publisher():
+            session.subscriptions = set(publishers)
+            for publisher in publishers:
+                with server.subscriber_lock(publisher):
+                    server.add_subscriber(publisher, session)
+            for publisher in session.subscriptions:
+                with server.subscriber_lock(publisher):
+                    server.discard_subscriber(publisher, session)
+            session.subscriptions = set()
+
+        def per_stripe():
+            server.add_subscriptions(session, publishers)
+            server.detach_session(session)
+            session.subscriptions = set()
+
+        print(f"login and logout with {count} subscriptions, {server.LOCK_STRIPES} lock stripes")
+        for name, fn in (("lock per publisher", per_publisher), ("lock per stripe", per_stripe)):
+            print(f"  {name:>18}: {time_per_call(fn, args.logins) * 1e3:7.2f} ms/session")
+
+    message = b"x" * 100
+    for count in args.followers:
+        publisher = "popular"
+        followers = [server.Session(object(), f"follower{i}", NullWriter()) for i in range(count)]
+        server.subscribers.clear()
+        server.subscriber_snapshots.clear()
+        for session in followers:
+            with server.subscriber_lock(publisher):
+                server.add_subscriber(publisher, session)
+
+        # The old deliver_notification_to_local.
+        def inline():
+            with server.subscriber_lock(publisher):
+                snapshot = tuple(server.subscribers.get(publisher, ()))
+            data = memoryview(f"Notification from {publisher}: ".encode() + message + b"\n")
+            for session in snapshot:
+                session.outbound.put(data)
+
+        def handed_off():
+            server.deliver_notification_to_local(publisher, message)
+
+        print(f"one notification to {count} local followers, FANOUT_CHUNK_SIZE={server.FANOUT_CHUNK_SIZE}")
+        inline_seconds = time_per_call(inline, args.notifications)
+        print(f"  {'inline copy':>18}: listener busy {inline_seconds * 1e6:8.1f} us")
+        listener_seconds = time_per_call(handed_off, args.notifications)
+        started = time.perf_counter()
+        while not server.notification_deliveries.empty():
+            snapshot, data = server.notification_deliveries.get_nowait()
+            for session in snapshot:
+                session.outbound.put(data)
+        thread_seconds = (time.perf_counter() - started) / args.notifications
+        print(f"  {'snapshot':>18}: listener busy {listener_seconds * 1e6:8.1f} us, "
+              f"delivery thread {thread_seconds * 1e6:8.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    engines = commands.add_parser("engines", help="threaded vs asyncio connection engine")
+    engines.add_argument("--connections", type=int, default=5000)
+    engines.add_argument("--messages", type=int, default=500)
+    engines.add_argument("--port", type=int, default=9100)
+    engines.set_defaults(func=run_engines)
+
+    fanout = commands.add_parser("fanout", help="encode-once room fan-out microbenchmark")
+    fanout.add_argument("--members", type=int, default=1000)
+    fanout.add_argument("--messages", type=int, default=2000)
+    fanout.add_argument("--size", type=int, default=100, help="message text length")
+    fanout.set_defaults(func=run_fanout)
+
+    contention = commands.add_parser("contention", help="global lock vs striped room locks")
+    contention.add_argument("--rooms", type=int, default=200)
+    contention.add_argument("--members", type=int, default=50)
+    contention.add_argument("--threads", type=int, default=32)
+    contention.add_argument("--seconds", type=float, default=3)
+    contention.add_argument("--move-ratio", type=float, default=0.1)
+    contention.set_defaults(func=run_contention)
+
+    heartbeat = commands.add_parser("heartbeat", help="per-user vs batched lease refresh")
+    heartbeat.add_argument("--sessions", type=int, nargs="+", default=[1000, 5000, 20000])
+    heartbeat.add_argument("--max-per-user", type=int, default=20000,
+                           help="skip the per-user loop above this many sessions")
+    heartbeat.set_defaults(func=run_heartbeat)
+
+    loginstorm = commands.add_parser("loginstorm", help="concurrent login throughput")
+    loginstorm.add_argument("--users", type=int, default=200)
+    loginstorm.add_argument("--rounds", type=int, default=3)
+    loginstorm.add_argument("--concurrency", type=int, default=200)
+    loginstorm.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    loginstorm.add_argument("--port", type=int, default=9100)
+    loginstorm.set_defaults(func=run_loginstorm)
+
+    handshake = commands.add_parser("handshake", help="full vs resumed, RSA vs ECDSA TLS handshakes")
+    handshake.add_argument("--handshakes", type=int, default=200)
+    handshake.set_defaults(func=run_handshake)
+
+    framing_parser = commands.add_parser("framing", help="str split vs LineFramer line parsing")
+    framing_parser.add_argument("--burst-mb", type=float, default=1)
+    framing_parser.set_defaults(func=run_framing)
+
+    coalesce = commands.add_parser("coalesce", help="room message coalescing on vs off")
+    coalesce.add_argument("--senders", type=int, default=4)
+    coalesce.add_argument("--messages", type=int, default=2000, help="messages per sender")
+    coalesce.add_argument("--window-ms", type=float, default=5)
+    coalesce.add_argument("--max-bytes", type=int, default=16384)
+    coalesce.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    coalesce.add_argument("--port", type=int, default=9100)
+    coalesce.set_defaults(func=run_coalesce)
+
+    inbox = commands.add_parser("inbox", help="offline inbox fan-out and drain cost")
+    inbox.add_argument("--followers", type=int, nargs="+", default=[100, 1000, 10000])
+    inbox.add_argument("--online", type=float, default=0.5, help="fraction of followers online")
+    inbox.add_argument("--publishes", type=int, default=50)
+    inbox.set_defaults(func=run_inbox)
+
+    metrics_parser = commands.add_parser("metrics", help="per-event cost of metrics recording")
+    metrics_parser.add_argument("--calls", type=int, default=1000000)
+    metrics_parser.add_argument("--threads", type=int, default=8)
+    metrics_parser.set_defaults(func=run_metrics)
+
+    sessions = commands.add_parser("sessions", help="memory and teardown cost per session")
+    sessions.add_argument("--sessions", type=int, nargs="+", default=[10000, 100000])
+    sessions.add_argument("--rooms", type=int, default=100)
+    sessions.add_argument("--publishers", type=int, default=1000, help="users that are followed")
+    sessions.add_argument("--follows", type=int, default=5, help="subscriptions per session")
+    sessions.set_defaults(func=run_sessions)
+
+    follows = commands.add_parser("follows", help="bulk subscription restore and large notification fan-out")
+    follows.add_argument("--subscriptions", type=int, nargs="+", default=[1000, 10000])
+    follows.add_argument("--followers", type=int, nargs="+", default=[10, 1000, 10000])
+    follows.add_argument("--logins", type=int, default=50)
+    follows.add_argument("--notifications", type=int, default=200)
+    follows.set_defaults(func=run_follows)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,52 @@
 import os
+import random
 import socket
+import time
 import threading
 import sys
 import bcrypt
 import ssl
 
+from framing import LineFramer, LineTooLong
+
 HOST = "localhost"
 PORT = int(os.environ.get("SERVER_PORT", 8000))
 print(f"Connecting to server on {HOST}:{PORT}...")
 
 SHARED_SALT = b"$2b$12$abcdefghijklmnopqrstuu"
+RECONNECT_ATTEMPTS = int(os.environ.get("RECONNECT_ATTEMPTS", "5"))
 
 
 def hash_password(pwd):
     return bcrypt.hashpw(pwd.encode(), SHARED_SALT).decode()
 
 
-def listen(sock):
-    buffer = ""
+def print_lines(state):
+    sock, framer = state["sock"], state["framer"]
     while True:
         try:
-            chunk = sock.recv(1024).decode()
-            if not chunk:
+            lines = framer.read_lines(sock)
+            if lines is None:
                 break
-
-            buffer += chunk
-            while "\n" in buffer:
-                msg, buffer = buffer.split("\n", 1)
-                print(msg)
+            for msg in lines:
+                text = msg.decode(errors="replace")
+                if text.startswith("RECONNECT "):
+                    # The server is draining: "RECONNECT <token> [host:port]".
+                    parts = text.split()
+                    state["resume"] = parts[1]
+                    if len(parts) > 2:
+                        host, _, port = parts[2].rpartition(":")
+                        state["address"] = (host, int(port))
+                    print("Server is restarting, moving your session...")
+                    continue
+                print(text)
+        except LineTooLong:
+            print("[line too long, dropped]")
         except:
             break
 
 
-def run_client():
+def create_ssl_context():
     # Create SSL context for certificate verification
     ssl_context = ssl.create_default_context()
     
@@ -49,35 +63,125 @@ def run_client():
         # but be aware this is less secure
         ssl_context.check_hostname = False
         ssl_context.verify_mode = ssl.CERT_NONE
-    
+    return ssl_context
+
+
+def connect(ssl_context, session=None, address=(HOST, PORT)):
+    # Passing the previous connection's session lets the server resume it
+    # instead of running a full handshake.
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock = ssl_context.wrap_socket(sock, server_hostname=HOST)
-    sock.connect((HOST, PORT))
+    sock = ssl_context.wrap_socket(sock, server_hostname=address[0], session=session)
+    sock.connect(address)
+    return sock
+
+
+def login(sock, framer, user, pwd_hash):
+    return request(sock, framer, f"LOGIN {user} {pwd_hash}\n")
+
+
+def resume(sock, framer, user, token):
+    # Takes over a session handed off by a draining server; no bcrypt.
+    return request(sock, framer, f"RESUME {user} {token}\n")
+
+
+def request(sock, framer, line):
+    sock.sendall(line.encode())
+    try:
+        line = framer.read_line(sock)
+    except LineTooLong:
+        line = None
+    return "" if line is None else line.decode(errors="replace") + "\n"
+
+
+def reconnect(state, ssl_context, user, pwd_hash):
+    for attempt in range(RECONNECT_ATTEMPTS):
+        time.sleep(min(2 ** attempt, 10) * random.uniform(0.5, 1))
+        # The token is single use: if resuming fails, log in again.
+        token, state["resume"] = state["resume"], None
+        try:
+            sock = connect(ssl_context, state["session"], state["address"])
+            framer = LineFramer()
+            if token:
+                response = resume(sock, framer, user, token)
+            else:
+                response = login(sock, framer, user, pwd_hash)
+        except OSError:
+            # Peer unreachable: keep the token and try our own server.
+            state["resume"] = token
+            state["address"] = (HOST, PORT)
+            continue
+        if "successful" in response:
+            resumed = " (TLS session resumed)" if sock.session_reused else ""
+            print(f"Reconnected{resumed}. {response}", end="")
+            state["sock"] = sock
+            state["framer"] = framer
+            state["session"] = sock.session
+            return True
+        print(response, end="")
+        sock.close()
+    return False
+
+
+def listen(state, ssl_context, user, pwd_hash):
+    while True:
+        print_lines(state)
+        if state["closing"]:
+            return
+        state["sock"].close()
+        print("Connection lost, reconnecting...")
+        if not reconnect(state, ssl_context, user, pwd_hash):
+            print("Could not reconnect")
+            os._exit(1)
+
+
+def run_client():
+    ssl_context = create_ssl_context()
+
+    try:
+        sock = connect(ssl_context)
+    except (ssl.SSLError, ConnectionResetError):
+        # A server that is over its admission limit closes before the TLS
+        # handshake completes.
+        print("Server busy, try again in a few seconds")
+        return
 
     user = input("Username: ")
     pwd = input("Password: ")
 
     pwd_hash = hash_password(pwd)
-    sock.sendall(f"LOGIN {user} {pwd_hash}\n".encode())
-
-    response = ""
-    while "\n" not in response:
-        response += sock.recv(1024).decode()
+    framer = LineFramer()
+    response = login(sock, framer, user, pwd_hash)
 
     print(response, end="")
     if "successful" not in response:
         sock.close()
         return
 
-    threading.Thread(target=listen, args=(sock,), daemon=True).start()
+    state = {
+        "sock": sock,
+        "framer": framer,
+        "session": sock.session,
+        "address": (HOST, PORT),
+        "resume": None,
+        "closing": False,
+    }
+    threading.Thread(
+        target=listen,
+        args=(state, ssl_context, user, pwd_hash),
+        daemon=True
+    ).start()
 
     try:
         while True:
             text = input()
-            sock.sendall((text + "\n").encode())
+            try:
+                state["sock"].sendall((text + "\n").encode())
+            except OSError:
+                print("Not connected, message not sent")
     except KeyboardInterrupt:
         print("\nClient closed")
-        sock.close()
+        state["closing"] = True
+        state["sock"].close()
         sys.exit()
 
 
@@ -0,0 +1,93 @@
+"""
+Newline-delimited framing for the chat protocol.
+
+LineFramer reads with recv_into() into one preallocated chunk, appends to a
+bytearray and only scans bytes it has not scanned before, so a large paste
+costs linear time. Complete lines are cut out of the buffer in one C-level
+split per read rather than one Python-level split per line. A line longer
+than max_line_length is dropped rather than buffered forever.
+"""
+
+import collections
+import os
+
+READ_SIZE = int(os.environ.get("READ_SIZE", "65536"))
+MAX_LINE_LENGTH = int(os.environ.get("MAX_LINE_LENGTH", "65536"))
+
+# Stands in the pending queue for a line that was dropped for being too long.
+OVERFLOW = object()
+
+
+class LineTooLong(Exception):
+    pass
+
+
+class LineFramer:
+
+    def __init__(self, read_size=READ_SIZE, max_line_length=MAX_LINE_LENGTH):
+        self.chunk = bytearray(read_size)
+        self.view = memoryview(self.chunk)
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.discarding = False
+        self.max_line_length = max_line_length
+        self.pending = collections.deque()
+
+    def feed(self, data):
+        """Append received bytes and queue every line they complete."""
+        self.buffer += data
+        last = self.buffer.rfind(b"\n", self.scanned)
+        if last >= 0:
+            # One copy of the completed block, split in C; the partial line
+            # after it stays in the buffer.
+            with memoryview(self.buffer) as view:
+                lines = view[:last].tobytes().split(b"\n")
+            del self.buffer[:last + 1]
+            if self.discarding:
+                # Tail of a line already reported as too long.
+                del lines[0]
+                self.discarding = False
+            if last > self.max_line_length:
+                lines = [OVERFLOW if len(line) > self.max_line_length else line for line in lines]
+            self.pending.extend(lines)
+        self.scanned = len(self.buffer)
+
+        if self.scanned > self.max_line_length:
+            if not self.discarding:
+                self.pending.append(OVERFLOW)
+                self.discarding = True
+            self.buffer.clear()
+            self.scanned = 0
+
+    def fill(self, sock):
+        """Receive until at least one line is queued; False at EOF."""
+        while not self.pending:
+            received = sock.recv_into(self.chunk)
+            if not received:
+                return False
+            self.feed(self.view[:received])
+        return True
+
+    def read_line(self, sock):
+        """Next line without its newline, or None at EOF.
+
+        Raises LineTooLong where an oversized line was dropped.
+        """
+        if not self.fill(sock):
+            return None
+        line = self.pending.popleft()
+        if line is OVERFLOW:
+            raise LineTooLong(self.max_line_length)
+        return line
+
+    def read_lines(self, sock):
+        """Every queued line up to the next dropped one, or None at EOF."""
+        if not self.fill(sock):
+            return None
+        if self.pending[0] is OVERFLOW:
+            self.pending.popleft()
+            raise LineTooLong(self.max_line_length)
+        lines = []
+        while self.pending and self.pending[0] is not OVERFLOW:
+            lines.append(self.pending.popleft())
+        return lines
@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
-"""Generate self-signed TLS certificates for testing."""
+"""Generate self-signed TLS certificates for testing.
+
+CERT_KEY_TYPE=ecdsa produces a P-256 key instead of RSA-4096; ECDSA
+signatures are far cheaper, which is most of the cost of a full handshake
+(see `python benchmark.py handshake`). CERT_FILE / KEY_FILE choose the
+output paths, as they do for the server.
+"""
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.hazmat.primitives import serialization
 from datetime import datetime, timedelta
 import os
 
+KEY_TYPE = os.environ.get("CERT_KEY_TYPE", "rsa")
+CERT_FILE = os.environ.get("CERT_FILE", "cert.pem")
+KEY_FILE = os.environ.get("KEY_FILE", "key.pem")
+
 # Generate private key
-private_key = rsa.generate_private_key(
-    public_exponent=65537,
-    key_size=4096,
-)
+if KEY_TYPE == "ecdsa":
+    private_key = ec.generate_private_key(ec.SECP256R1())
+else:
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=4096,
+    )
 
 # Generate certificate
 subject = issuer = x509.Name([
@@ -42,7 +55,7 @@ cert = x509.CertificateBuilder().subject_name(
 ).sign(private_key, hashes.SHA256())
 
 # Write private key
-with open('key.pem', 'wb') as f:
+with open(KEY_FILE, 'wb') as f:
     f.write(private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.TraditionalOpenSSL,
@@ -50,7 +63,7 @@ with open('key.pem', 'wb') as f:
     ))
 
 # Write certificate
-with open('cert.pem', 'wb') as f:
+with open(CERT_FILE, 'wb') as f:
     f.write(cert.public_bytes(serialization.Encoding.PEM))
 
-print("Certificates generated: cert.pem and key.pem")
+print(f"Certificates generated ({KEY_TYPE}): {CERT_FILE} and {KEY_FILE}")
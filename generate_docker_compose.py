@@ -3,14 +3,64 @@
 Generate docker-compose.yml with N server instances.
 Usage: python generate_docker_compose.py 5
 This creates 5 chat server instances on ports 8000-8004
+
+Usage: python generate_docker_compose.py 5 --redis-cluster 3
+Same, but backed by a 3-node Redis Cluster instead of a single Redis
+
+Usage: python generate_docker_compose.py 5 --workers 4
+Each server runs 4 worker processes on its port (SERVER_WORKERS)
 """
 
 import sys
 import yaml
 import os
 
-def generate_docker_compose(num_servers):
-    """Generate docker-compose configuration with N server instances."""
+def redis_cluster_services(num_nodes):
+    """Redis Cluster nodes redis1..redisN plus a one-shot service that joins
+    them into a cluster (skipped if the cluster already exists)."""
+    services = {}
+    hosts = [f'redis{i}' for i in range(1, num_nodes + 1)]
+    for i, host in enumerate(hosts, start=1):
+        services[host] = {
+            'image': 'redis:7-alpine',
+            'container_name': f'chat_redis{i}',
+            'command': [
+                'redis-server', '--port', '6379',
+                '--cluster-enabled', 'yes',
+                '--cluster-config-file', 'nodes.conf',
+                '--appendonly', 'no'
+            ],
+            'ports': [f'{6379 + i - 1}:6379'],
+            'networks': ['chat_network'],
+            'healthcheck': {
+                'test': ['CMD', 'redis-cli', 'ping'],
+                'interval': '5s',
+                'timeout': '3s',
+                'retries': 5
+            }
+        }
+    # redis-cli --cluster create wants addresses, so resolve the hostnames.
+    addresses = ' '.join(f'$$(getent hosts {host} | cut -d" " -f1):6379' for host in hosts)
+    services['redis-cluster-init'] = {
+        'image': 'redis:7-alpine',
+        'container_name': 'chat_redis_cluster_init',
+        'command': [
+            'sh', '-c',
+            'redis-cli -h redis1 cluster info | grep -q cluster_state:ok || '
+            f'redis-cli --cluster create {addresses} --cluster-replicas 0 --cluster-yes'
+        ],
+        'depends_on': {host: {'condition': 'service_healthy'} for host in hosts},
+        'networks': ['chat_network']
+    }
+    return services
+
+
+def generate_docker_compose(num_servers, redis_nodes=0, workers=1):
+    """Generate docker-compose configuration with N server instances.
+
+    With redis_nodes > 0 the servers use a Redis Cluster of that many nodes.
+    With workers > 1 every server runs that many worker processes.
+    """
     
     if num_servers < 1:
         print("Error: Number of servers must be at least 1")
@@ -43,6 +93,11 @@ def generate_docker_compose(num_servers):
         }
     }
     
+    if redis_nodes > 0:
+        del config['services']['redis']
+        del config['volumes']
+        config['services'].update(redis_cluster_services(redis_nodes))
+
     # Generate N server instances
     for i in range(1, num_servers + 1):
         port = 8000 + (i - 1)
@@ -63,7 +118,10 @@ def generate_docker_compose(num_servers):
                 'CERT_FILE=/app/cert.pem',
                 'KEY_FILE=/app/key.pem'
             ],
-            'ports': [f'{port}:{port}'],
+            # Chat port and the plaintext metrics port (SERVER_PORT + 1000)
+            'ports': [f'{port}:{port}', f'{port + 1000}:{port + 1000}'],
+            # docker stop sends SIGTERM; leave time to drain (DRAIN_TIMEOUT_SECONDS)
+            'stop_grace_period': '20s',
             'depends_on': {
                 'redis': {
                     'condition': 'service_healthy'
@@ -75,33 +133,70 @@ def generate_docker_compose(num_servers):
                 './key.pem:/app/key.pem:ro'
             ]
         }
+        # A draining server sends its clients to one of the others, by the
+        # host ports clients connect to.
+        peers = [f'localhost:{8000 + j}' for j in range(num_servers) if j != i - 1]
+        if peers:
+            config['services'][server_id]['environment'].append(f'PEER_ADDRESSES={",".join(peers)}')
+        if workers > 1:
+            config['services'][server_id]['environment'].append(f'SERVER_WORKERS={workers}')
+        if redis_nodes > 0:
+            # Any node will do as the entry point; the client discovers the rest.
+            service = config['services'][server_id]
+            service['environment'] = [
+                'REDIS_HOST=redis1' if env == 'REDIS_HOST=redis' else env
+                for env in service['environment']
+            ] + ['REDIS_CLUSTER=1']
+            service['depends_on'] = {
+                'redis-cluster-init': {
+                    'condition': 'service_completed_successfully'
+                }
+            }
     
     return config
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python generate_docker_compose.py <number_of_servers>")
+    options = dict(zip(sys.argv[2::2], sys.argv[3::2]))
+    if len(sys.argv) < 2 or len(sys.argv) % 2 or set(options) - {"--redis-cluster", "--workers"}:
+        print("Usage: python generate_docker_compose.py <number_of_servers> [--redis-cluster <nodes>] [--workers <n>]")
         print("Example: python generate_docker_compose.py 5")
+        print("Example: python generate_docker_compose.py 5 --redis-cluster 3")
+        print("Example: python generate_docker_compose.py 2 --workers 4")
         sys.exit(1)
     
     try:
         num_servers = int(sys.argv[1])
+        redis_nodes = int(options.get("--redis-cluster", 0))
+        workers = int(options.get("--workers", 1))
     except ValueError:
-        print(f"Error: '{sys.argv[1]}' is not a valid number")
+        print(f"Error: '{' '.join(sys.argv[1:])}' are not valid numbers")
+        sys.exit(1)
+    
+    if 0 < redis_nodes < 3:
+        print("Error: A Redis Cluster needs at least 3 nodes")
+        sys.exit(1)
+    if workers < 1:
+        print("Error: Number of workers must be at least 1")
         sys.exit(1)
     
     print(f"Generating docker-compose.yml with {num_servers} server instance(s)...")
     
-    config = generate_docker_compose(num_servers)
+    config = generate_docker_compose(num_servers, redis_nodes, workers)
     
     # Write to docker-compose.yml
     with open('docker-compose.yml', 'w') as f:
         yaml.dump(config, f, default_flow_style=False, sort_keys=False)
     
     print(f"✓ Successfully created docker-compose.yml with {num_servers} server instance(s)")
-    print(f"  Redis: port 6379")
+    if redis_nodes > 0:
+        print(f"  Redis Cluster: {redis_nodes} nodes on ports 6379-{6379 + redis_nodes - 1}")
+    else:
+        print(f"  Redis: port 6379")
     print(f"  Servers: ports 8000-{8000 + num_servers - 1}")
+    if workers > 1:
+        print(f"  Workers: {workers} per server")
+    print(f"  Metrics: ports 9000-{9000 + num_servers - 1} (/metrics)")
     print(f"\nNext step: docker-compose up --build")
 
 
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Headless load generator for the chat cluster.
+
+Usage: python loadgen.py [--ports 8000-8004] [--users 1000] [--duration 30]
+       python loadgen.py --local [--fakeredis] [--ports 9200-9201] [--users 200]
+
+Simulated users log in over TLS with the LOGIN/slash-command protocol,
+spread round-robin over the given server ports (8000-8004 for a
+docker-compose.yml generated with 5 servers). Each joins one of --rooms
+rooms, subscribes to --follows other users, then sends a Poisson stream of
+--rate actions per second, picked by the weights of --mix: a chat line to
+its room, a /join to another room, a /publish to its followers or a
+/rooms listing.
+
+Chat lines and notifications carry a send timestamp, so every delivery
+read by a simulated user is a fan-out latency sample. /join and /rooms are
+timed until their reply. A user whose connection is refused as busy retries
+with backoff like client.py; users that still cannot connect, are refused
+at login or drop during the run count as failures.
+
+Missing users (load_0, load_1, ...) are registered first through
+server.py against REDIS_HOST/REDIS_PORT, so the load generator must see the
+same Redis as the servers (docker-compose publishes it on 6379).
+
+--local starts one server.py per port on this machine instead, against
+REDIS_HOST/REDIS_PORT or, with --fakeredis, an in-process fakeredis server
+(pip install fakeredis), so a run needs neither Docker nor Redis.
+--max-failure-rate makes the exit status fail a CI job.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from benchmark import client_hash, client_ssl_context, percentile, raise_nofile_limit, start_server_process
+
+ACTIONS = ("chat", "join", "publish", "rooms")
+DELIVERIES = ("chat", "publish")
+# Replies that end a timed command.
+REPLIES = {b"Joined room ": "join", b"Available rooms": "rooms", b"Top rooms": "rooms"}
+
+
+def parse_ports(spec):
+    """"8000-8004,8010" -> [8000, 8001, 8002, 8003, 8004, 8010]"""
+    ports = []
+    for part in spec.split(","):
+        first, _, last = part.partition("-")
+        ports.extend(range(int(first), int(last or first) + 1))
+    return ports
+
+
+def parse_mix(spec):
+    """"chat=70,join=10" -> {"chat": 70.0, "join": 10.0}"""
+    mix = {}
+    for part in spec.split(","):
+        action, _, weight = part.partition("=")
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action {action!r}, expected one of {', '.join(ACTIONS)}")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+class LoadStats:
+
+    def __init__(self):
+        self.connected = 0
+        self.retries = 0
+        self.failures = {"connect": 0, "login": 0, "disconnect": 0}
+        self.login = []
+        self.sent = dict.fromkeys(ACTIONS, 0)
+        self.latency = {name: [] for name in DELIVERIES + ("join", "rooms")}
+
+    def summary(self, users, elapsed):
+        failed = sum(self.failures.values())
+        result = {
+            "users": users,
+            "connected": self.connected,
+            "retries": self.retries,
+            "failures": dict(self.failures),
+            "failure_rate": failed / users if users else 0.0,
+            "seconds": elapsed,
+            "login_ms": latency_summary(self.login),
+            "actions_per_second": {a: n / elapsed for a, n in self.sent.items()},
+        }
+        for name, values in self.latency.items():
+            result[f"{name}_ms"] = latency_summary(values)
+            if name in DELIVERIES:
+                result[f"{name}_deliveries_per_second"] = len(values) / elapsed
+        return result
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50) * 1000,
+        "p99": percentile(values, 99) * 1000,
+        "p999": percentile(values, 99.9) * 1000,
+    }
+
+
+class SimulatedUser:
+
+    def __init__(self, name, host, port, marker, stats):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.marker = marker
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.pending = {"join": [], "rooms": []}
+        self.closing = False
+
+    async def connect(self, ssl_context, retries):
+        """Log in, retrying busy servers with backoff like client.py does."""
+        started = time.perf_counter()
+        for attempt in range(retries + 1):
+            if attempt:
+                self.stats.retries += 1
+                await asyncio.sleep(min(2 ** attempt, 10) * random.uniform(0.5, 1))
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port, ssl=ssl_context, server_hostname="localhost"
+                )
+                self.writer.write(f"LOGIN {self.name} {client_hash()}\n".encode())
+                response = await self.reader.readline()
+            except (OSError, asyncio.IncompleteReadError):
+                # Admission control refuses the handshake when busy.
+                continue
+            if b"successful" in response:
+                self.stats.login.append(time.perf_counter() - started)
+                self.stats.connected += 1
+                return True
+            self.writer.close()
+            if not response.startswith(b"Server busy"):
+                self.stats.failures["login"] += 1
+                return False
+        self.stats.failures["connect"] += 1
+        return False
+
+    def send(self, action, line):
+        if action in self.pending:
+            self.pending[action].append(time.perf_counter())
+        self.stats.sent[action] += 1
+        self.writer.write(line.encode())
+
+    async def receive(self):
+        marker = self.marker
+        skip = 0
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                line = b""
+            if not line:
+                if not self.closing:
+                    self.stats.failures["disconnect"] += 1
+                return
+            if skip:
+                skip -= 1
+                continue
+            if line.startswith(b"--- last "):
+                # A room's history backfill replays old lines; not deliveries.
+                skip = int(line.split()[2])
+                continue
+            index = line.find(marker)
+            if index >= 0:
+                sent_at = float(line[index + len(marker):])
+                kind = "publish" if line.startswith(b"Notification from ") else "chat"
+                self.stats.latency[kind].append(time.perf_counter() - sent_at)
+                continue
+            for prefix, action in REPLIES.items():
+                if line.startswith(prefix) and self.pending[action]:
+                    self.stats.latency[action].append(time.perf_counter() - self.pending[action].pop(0))
+                    break
+
+    async def run(self, deadline, rate, mix, rooms):
+        actions, weights = list(mix), list(mix.values())
+        marker = self.marker.decode()
+        while True:
+            await asyncio.sleep(min(random.expovariate(rate), max(0, deadline - time.perf_counter())))
+            if time.perf_counter() >= deadline or self.writer.is_closing():
+                return
+            action = random.choices(actions, weights)[0]
+            if action == "chat":
+                self.send(action, f"{marker}{time.perf_counter()}\n")
+            elif action == "join":
+                self.send(action, f"/join load_room_{random.randrange(rooms)}\n")
+            elif action == "publish":
+                self.send(action, f"/publish {marker}{time.perf_counter()}\n")
+            else:
+                self.send(action, "/rooms\n")
+            try:
+                await self.writer.drain()
+            except OSError:
+                return
+
+    def close(self):
+        self.closing = True
+        self.writer.close()
+
+
+async def run_load(args, names):
+    ssl_context = client_ssl_context()
+    stats = LoadStats()
+    # Unique per run, so history and inboxes left by earlier runs are ignored.
+    marker = f"~lg{random.getrandbits(32):08x} ".encode()
+    users = [
+        SimulatedUser(name, args.host, args.ports[i % len(args.ports)], marker, stats)
+        for i, name in enumerate(names)
+    ]
+
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def connect(user):
+        async with slots:
+            return await user.connect(ssl_context, args.retries)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(connect(u) for u in users))
+    online = [u for u, ok in zip(users, results) if ok]
+    print(f"{len(online)}/{len(users)} users logged in in {time.perf_counter() - started:.1f}s")
+
+    receivers = [asyncio.create_task(u.receive()) for u in online]
+    for user in online:
+        user.send("join", f"/join load_room_{random.randrange(args.rooms)}\n")
+        for other in random.sample(names, min(args.follows, len(names))):
+            if other != user.name:
+                user.writer.write(f"/subscribe {other}\n".encode())
+    # Let the joins and subscriptions settle before measuring.
+    await asyncio.sleep(args.settle)
+    for name in ACTIONS:
+        stats.sent[name] = 0
+    for values in stats.latency.values():
+        values.clear()
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(u.run(deadline, args.rate, args.mix, args.rooms) for u in online))
+    elapsed = time.perf_counter() - started
+    # Deliveries still in flight when the senders stop count, late.
+    await asyncio.sleep(args.drain)
+
+    for user in online:
+        user.close()
+    await asyncio.gather(*receivers)
+    return stats.summary(len(users), elapsed)
+
+
+def print_summary(result):
+    failures = result["failures"]
+    print(f"users: {result['connected']}/{result['users']} connected; "
+          f"{failures['connect']} connect failures, {failures['login']} rejected logins, "
+          f"{failures['disconnect']} disconnects ({result['failure_rate']:.2%} failed), "
+          f"{result['retries']} busy retries")
+    login = result["login_ms"]
+    print(f"login: p50={login['p50']:.1f}ms p99={login['p99']:.1f}ms p999={login['p999']:.1f}ms")
+    rates = ", ".join(f"{a} {n:,.0f}/s" for a, n in result["actions_per_second"].items())
+    print(f"actions over {result['seconds']:.1f}s: {rates}")
+    for name in DELIVERIES + ("join", "rooms"):
+        latency = result[f"{name}_ms"]
+        if name in DELIVERIES:
+            label = f"{name} fan-out: {result[f'{name}_deliveries_per_second']:,.0f} deliveries/s"
+        else:
+            label = f"{name} reply: {latency['count']} replies"
+        print(f"{label}, p50={latency['p50']:.2f}ms p99={latency['p99']:.2f}ms p999={latency['p999']:.2f}ms")
+
+
+def start_fakeredis(port):
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        sys.exit("--fakeredis needs the fakeredis package: pip install fakeredis lupa")
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    # Connection threads must not keep the process alive at exit.
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def register_users(names):
+    import server
+
+    missing = [u for u in names if not server.user_exists(u)]
+    if not missing:
+        return
+    print(f"registering {len(missing)} users...")
+
+    # server.register_user() would redo the client-side hash for every user.
+    def register(user):
+        stored = bcrypt.hashpw(client_hash().encode(), bcrypt.gensalt(server.BCRYPT_ROUNDS)).decode()
+        server.redis_client.set(server.credentials_key(user), stored)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as pool:
+        list(pool.map(register, missing))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat cluster load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ports", type=parse_ports, default=[8000],
+                        help="server ports, e.g. 8000-8004 (default 8000)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--rate", type=float, default=1, help="actions per user per second")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=70,join=10,publish=10,rooms=10"),
+                        help="action weights (default chat=70,join=10,publish=10,rooms=10)")
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--follows", type=int, default=3, help="users each user subscribes to")
+    parser.add_argument("--concurrency", type=int, default=200, help="logins in flight")
+    parser.add_argument("--retries", type=int, default=3, help="reconnects after a busy server")
+    parser.add_argument("--settle", type=float, default=2, help="seconds between setup and load")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for late deliveries")
+    parser.add_argument("--no-register", dest="register", action="store_false",
+                        help="assume load_0..load_N-1 exist")
+    parser.add_argument("--local", action="store_true", help="start a server.py per port on this machine")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded", help="with --local")
+    parser.add_argument("--fakeredis", action="store_true", help="with --local: in-process fakeredis")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--max-failure-rate", type=float, help="exit 1 if more users than this fail")
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+    if args.local:
+        if args.fakeredis:
+            port = int(os.environ.get("REDIS_PORT", "6399"))
+            start_fakeredis(port)
+            os.environ.update({"REDIS_HOST": "127.0.0.1", "REDIS_PORT": str(port)})
+        # Cheap password hashes: registering thousands of users is not
+        # what is being measured.
+        os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+    names = [f"load_{i}" for i in range(args.users)]
+    if args.register:
+        register_users(names)
+
+    processes = []
+    try:
+        if args.local:
+            processes = [
+                start_server_process(args.engine, port, {"METRICS_PORT": "0"})
+                for port in args.ports
+            ]
+        result = asyncio.run(run_load(args, names))
+    finally:
+        for proc in processes:
+            proc.terminate()
+            proc.wait()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_summary(result)
+    if args.max_failure_rate is not None and result["failure_rate"] > args.max_failure_rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Process metrics in the Prometheus text format, without dependencies.
+
+Counters, callback gauges and log-linear latency histograms. Recording is a
+bisect and two increments under a short lock, cheap enough to leave on;
+rendering only happens when /metrics is scraped. serve() exposes the
+registry over plain HTTP on its own port, away from the TLS chat port.
+"""
+
+import bisect
+import http.server
+import threading
+import time
+
+# HDR-style buckets: two per power of two (about 41% apart) from 10 us to
+# about 84 s, so relative precision is the same for fast and slow events.
+BUCKET_BOUNDS = tuple(10e-6 * 2 ** (i / 2) for i in range(47))
+
+registry = []
+
+
+def format_labels(label, value):
+    if not label:
+        return ""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{label}="{escaped}"}}'
+
+
+class Counter:
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, label_value=""):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, count in values:
+            lines.append(f"{self.name}{format_labels(self.label, value)} {count}")
+        return lines
+
+
+class Gauge:
+    """Read at scrape time from fn, which returns a number, or a dict of
+    label value -> number when label is set. kind="counter" exposes totals
+    that are kept elsewhere (e.g. admission counters)."""
+
+    def __init__(self, name, help, fn, label=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+        self.kind = kind
+        registry.append(self)
+
+    def render(self):
+        value = self.fn()
+        values = sorted(value.items()) if self.label else [("", value)]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_value, number in values:
+            lines.append(f"{self.name}{format_labels(self.label, label_value)} {number}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        # label value -> [bucket counts..., overflow count]; sums separately
+        self.counts = {}
+        self.sums = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, seconds, label_value=""):
+        index = bisect.bisect_left(BUCKET_BOUNDS, seconds)
+        with self.lock:
+            counts = self.counts.get(label_value)
+            if counts is None:
+                counts = self.counts[label_value] = [0] * (len(BUCKET_BOUNDS) + 1)
+                self.sums[label_value] = 0.0
+            counts[index] += 1
+            self.sums[label_value] += seconds
+
+    def render(self):
+        with self.lock:
+            series = sorted((value, list(counts), self.sums[value]) for value, counts in self.counts.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, counts, total in series:
+            prefix = f'{self.label}="{value}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip(BUCKET_BOUNDS, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound:.6g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            labels = format_labels(self.label, value)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class TimedLock:
+    """threading.Lock that records how long contended acquisitions waited.
+
+    Uncontended acquisitions take the non-blocking fast path and record
+    nothing, so wrapping a hot lock costs one extra call.
+    """
+
+    def __init__(self, histogram, label_value=""):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        if self.lock.acquire(blocking=False):
+            return self
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.histogram.observe(time.perf_counter() - start, self.label_value)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    """Serve /metrics on a daemon thread."""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
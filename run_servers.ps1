@@ -1,10 +1,14 @@
 # PowerShell script to run docker-compose with N server instances
-# Usage: .\run_servers.ps1 -NumServers 5
+# Usage: .\run_servers.ps1 -NumServers 5 [-RedisClusterNodes 3] [-Workers 4]
 
 param(
     [Parameter(Mandatory=$true)]
     [ValidateRange(1, [int]::MaxValue)]
-    [int]$NumServers
+    [int]$NumServers,
+
+    [int]$RedisClusterNodes = 0,
+
+    [int]$Workers = 1
 )
 
 Write-Host "==========================================" -ForegroundColor Cyan
@@ -15,7 +19,14 @@ Write-Host ""
 Write-Host "Generating configuration for $NumServers server instance(s)..." -ForegroundColor Yellow
 
 # Run the Python script
-python generate_docker_compose.py $NumServers
+$extraArgs = @()
+if ($RedisClusterNodes -gt 0) {
+    $extraArgs += @("--redis-cluster", $RedisClusterNodes)
+}
+if ($Workers -gt 1) {
+    $extraArgs += @("--workers", $Workers)
+}
+python generate_docker_compose.py $NumServers @extraArgs
 
 if ($LASTEXITCODE -eq 0) {
     Write-Host ""
@@ -1,10 +1,10 @@
 #!/bin/bash
 # Wrapper script to easily run docker-compose with N server instances
-# Usage: ./run_servers.sh 5
+# Usage: ./run_servers.sh 5 [--redis-cluster 3] [--workers 4]
 # This generates docker-compose.yml with 5 servers and starts them
 
 if [ $# -eq 0 ]; then
-    echo "Usage: $0 <number_of_servers>"
+    echo "Usage: $0 <number_of_servers> [--redis-cluster <nodes>] [--workers <n>]"
     echo "Example: $0 5"
     echo ""
     echo "This will:"
@@ -26,7 +26,7 @@ echo "Chat Server Multi-Instance Launcher"
 echo "========================================="
 echo ""
 echo "Generating configuration for $NUM_SERVERS server instance(s)..."
-python generate_docker_compose.py "$NUM_SERVERS"
+python generate_docker_compose.py "$@"
 
 if [ $? -eq 0 ]; then
     echo ""
@@ -5,8 +5,26 @@ import json
 import os
 import uuid
 import ssl
+import queue
+import collections
+import struct
+import time
+import hashlib
+import random
+import secrets
+import bisect
+import signal
+import subprocess
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+import metrics
+from framing import LineFramer, LineTooLong
 
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = int(os.environ.get("SERVER_PORT", 8000))
@@ -15,30 +33,434 @@ MAIN_ROOM = "lobby"
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 REDIS_DB = int(os.environ.get("REDIS_DB", "0"))
+# Redis Cluster (7+): REDIS_HOST/REDIS_PORT name any node. Room channels use
+# sharded pub/sub and room history is spread by room name, so room traffic
+# scales with the shards; the rest of the state shares one hash tag (see
+# CLUSTER_TAG). Sharded pub/sub can also be used on a single Redis 7.
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER", "0") == "1"
+REDIS_SHARDED_PUBSUB = REDIS_CLUSTER or os.environ.get("REDIS_SHARDED_PUBSUB", "0") == "1"
 SERVER_ID = os.environ.get("SERVER_ID", str(uuid.uuid4()))
 
 ACTIVE_TTL_SECONDS = int(os.environ.get("ACTIVE_TTL_SECONDS", "15"))
 HEARTBEAT_INTERVAL_SECONDS = int(os.environ.get("HEARTBEAT_INTERVAL_SECONDS", "5"))
-
-redis_client = redis.Redis(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    db=REDIS_DB,
-    decode_responses=True
-)
-
-
-connection_to_user = {}
-user_credentials = {}
-user_location = {}
-
-room_connections = {MAIN_ROOM: set()}
+HEARTBEAT_BATCH_SIZE = int(os.environ.get("HEARTBEAT_BATCH_SIZE", "500"))
+# With sharded pub/sub on a cluster, room messages are only picked up between
+# polls of the other channels, so the poll is shorter.
+PUBSUB_POLL_SECONDS = float(os.environ.get(
+    "PUBSUB_POLL_SECONDS", "0.005" if REDIS_CLUSTER else "0.05"))
+LOCK_STRIPES = int(os.environ.get("LOCK_STRIPES", "64"))
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+AUTH_WORKERS = int(os.environ.get("AUTH_WORKERS", str(os.cpu_count() or 2)))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = int(os.environ.get("AUTH_CACHE_TTL_SECONDS", "600"))
+
+# Admission control (see AdmissionController): a reconnect storm from a dead
+# node must not drown this one in TLS handshakes and bcrypt.
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", "4096"))
+ACCEPT_RATE = float(os.environ.get("ACCEPT_RATE", "200"))
+ACCEPT_BURST = int(os.environ.get("ACCEPT_BURST", "400"))
+MAX_PENDING_LOGINS = int(os.environ.get("MAX_PENDING_LOGINS", "64"))
+HANDSHAKE_TIMEOUT_SECONDS = float(os.environ.get("HANDSHAKE_TIMEOUT_SECONDS", "10"))
+ADMISSION_RETRY_SECONDS = int(os.environ.get("ADMISSION_RETRY_SECONDS", "2"))
+# TLS 1.3 session tickets issued after each full handshake; 0 disables
+# resumption.
+TLS_SESSION_TICKETS = int(os.environ.get("TLS_SESSION_TICKETS", "2"))
+
+# Chat messages are also appended to a capped stream per room (history:<room>)
+# so /join can show recent messages. HISTORY_LENGTH=0 turns history off.
+HISTORY_LENGTH = int(os.environ.get("HISTORY_LENGTH", "1000"))
+HISTORY_BACKFILL = int(os.environ.get("HISTORY_BACKFILL", "20"))
+HISTORY_TTL_SECONDS = int(os.environ.get("HISTORY_TTL_SECONDS", "86400"))
+
+# Notifications for offline subscribers are kept in inbox:<user> (newest
+# INBOX_LENGTH, for INBOX_TTL_SECONDS) and delivered at their next login.
+# INBOX_LENGTH=0 turns the inbox off.
+INBOX_LENGTH = int(os.environ.get("INBOX_LENGTH", "100"))
+INBOX_TTL_SECONDS = int(os.environ.get("INBOX_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Presence: the "presence" sorted set scores each online user by lease expiry.
+# Servers keep a local sorted snapshot current from presence events and
+# reload it in full only every PRESENCE_RESYNC_SECONDS.
+PRESENCE_RESYNC_SECONDS = float(os.environ.get("PRESENCE_RESYNC_SECONDS", "60"))
+PRESENCE_PRUNE_BATCH = int(os.environ.get("PRESENCE_PRUNE_BATCH", "1000"))
+USERS_PAGE_SIZE = int(os.environ.get("USERS_PAGE_SIZE", "50"))
+
+# Every server keeps server:<SERVER_ID> alive for NODE_TTL_SECONDS; survivors
+# reap the sessions and room memberships of servers whose key expired.
+NODE_TTL_SECONDS = int(os.environ.get("NODE_TTL_SECONDS", str(3 * HEARTBEAT_INTERVAL_SECONDS)))
+REAPER_BATCH_SIZE = int(os.environ.get("REAPER_BATCH_SIZE", "500"))
+
+ROOMS_CACHE_TTL_SECONDS = float(os.environ.get("ROOMS_CACHE_TTL_SECONDS", "1"))
+ROOMS_PAGE_SIZE = int(os.environ.get("ROOMS_PAGE_SIZE", "50"))
+
+OUTBOUND_QUEUE_SIZE = int(os.environ.get("OUTBOUND_QUEUE_SIZE", "256"))
+# What to do when a client's outbound queue is full:
+#   drop_oldest - discard the oldest queued message
+#   disconnect  - drop the slow consumer
+#   block       - wait up to BACKPRESSURE_BLOCK_SECONDS, then drop the message
+BACKPRESSURE_POLICY = os.environ.get("BACKPRESSURE_POLICY", "drop_oldest")
+BACKPRESSURE_BLOCK_SECONDS = float(os.environ.get("BACKPRESSURE_BLOCK_SECONDS", "1"))
+
+# Notifications are delivered by their own thread (task), off the pub/sub
+# listener, so a publisher with thousands of local followers does not stall
+# room messages. It yields after every FANOUT_CHUNK_SIZE followers.
+FANOUT_CHUNK_SIZE = int(os.environ.get("FANOUT_CHUNK_SIZE", "500"))
+
+# Flood protection: token buckets (per second, 0 disables) on the lines each
+# connection sends, on each user across the cluster, and on the chat
+# messages of each room across the cluster. What to do with a line over a
+# limit:
+#   throttle   - stop reading from the client until a token is available
+#   drop       - discard the line and tell the sender
+#   disconnect - drop the client
+RATE_LIMIT_CONNECTION_RATE = float(os.environ.get("RATE_LIMIT_CONNECTION_RATE", "20"))
+RATE_LIMIT_CONNECTION_BURST = int(os.environ.get("RATE_LIMIT_CONNECTION_BURST", "50"))
+RATE_LIMIT_USER_RATE = float(os.environ.get("RATE_LIMIT_USER_RATE", "20"))
+RATE_LIMIT_USER_BURST = int(os.environ.get("RATE_LIMIT_USER_BURST", "50"))
+RATE_LIMIT_ROOM_RATE = float(os.environ.get("RATE_LIMIT_ROOM_RATE", "500"))
+RATE_LIMIT_ROOM_BURST = int(os.environ.get("RATE_LIMIT_ROOM_BURST", "1000"))
+RATE_LIMIT_POLICY = os.environ.get("RATE_LIMIT_POLICY", "throttle")
+# How often the user and room tokens taken here are added up in Redis.
+RATE_LIMIT_SYNC_SECONDS = float(os.environ.get("RATE_LIMIT_SYNC_SECONDS", "1"))
+
+# Pub/sub envelope: "json" or "binary" (length-prefixed, see encode_envelope)
+ENVELOPE_FORMAT = os.environ.get("ENVELOPE_FORMAT", "json")
+
+# Coalescing (off unless COALESCE_WINDOW_MS > 0): room messages published
+# within the window, up to COALESCE_MAX_BYTES, go out as one Redis publish
+# per room, and each writer sends everything queued for its client, up to
+# COALESCE_MAX_BYTES, in one write. Every node must understand room_batch
+# envelopes before any node turns this on.
+COALESCE_WINDOW_MS = float(os.environ.get("COALESCE_WINDOW_MS", "0"))
+COALESCE_MAX_BYTES = int(os.environ.get("COALESCE_MAX_BYTES", "16384"))
+
+# "threaded" (one thread per client) or "asyncio" (see async_server.py)
+SERVER_ENGINE = os.environ.get("SERVER_ENGINE", "threaded")
+# Worker processes sharing SERVER_PORT (see run_workers); --workers overrides.
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+# Set by run_workers: bind SERVER_PORT with SO_REUSEPORT.
+SERVER_REUSE_PORT = os.environ.get("SERVER_REUSE_PORT") == "1"
+# On SIGTERM/SIGINT (or an admin's /drain) a server stops accepting, hands
+# its connections off and waits this long for their sessions to clean up.
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("DRAIN_TIMEOUT_SECONDS", "10"))
+# Draining hands sessions off instead of dropping them: each client gets a
+# single-use resume token, valid this long, and comes back with RESUME on one
+# of PEER_ADDRESSES (host:port as clients reach them), or on the address it
+# used if none are set. 0 just closes the connections.
+RESUME_TTL_SECONDS = int(os.environ.get("RESUME_TTL_SECONDS", "60"))
+PEER_ADDRESSES = [a for a in os.environ.get("PEER_ADDRESSES", "").split(",") if a]
+# Users allowed to /drain the server they are connected to.
+ADMIN_USERS = {u for u in os.environ.get("ADMIN_USERS", "").split(",") if u}
+
+# Prometheus metrics over plain HTTP (see metrics.py); 0 disables.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", str(SERVER_PORT + 1000)))
+
+auth_seconds = metrics.Histogram(
+    "chat_auth_seconds", "Credential verification time, including bcrypt", "result")
+delivery_seconds = metrics.Histogram(
+    "chat_delivery_seconds", "Time from publish on any server to local delivery", "type")
+send_seconds = metrics.Histogram(
+    "chat_send_seconds", "Time spent writing to a client connection")
+lock_wait_seconds = metrics.Histogram(
+    "chat_lock_wait_seconds", "Wait of lock acquisitions that found the lock taken", "lock")
+redis_seconds = metrics.Histogram(
+    "chat_redis_command_seconds", "Redis round-trip by command (pipelines count as MULTI)", "command")
+messages_published = metrics.Counter(
+    "chat_messages_published_total", "Room messages published by this server")
+rate_limited_lines = metrics.Counter(
+    "chat_rate_limited_total", "Client lines over a rate limit, by the limit they hit", "level")
+resumes = metrics.Counter(
+    "chat_resumes_total", "Sessions handed off by this server on drain or resumed here", "result")
+
+# Redis connections. Chat publishes, control commands (logins, rooms,
+# subscriptions) and the heartbeat each get their own bounded pool, so a
+# burst on one workload queues behind its own pool instead of the others.
+REDIS_PUBLISH_POOL_SIZE = int(os.environ.get("REDIS_PUBLISH_POOL_SIZE", "64"))
+REDIS_CONTROL_POOL_SIZE = int(os.environ.get("REDIS_CONTROL_POOL_SIZE", "32"))
+REDIS_HEARTBEAT_POOL_SIZE = int(os.environ.get("REDIS_HEARTBEAT_POOL_SIZE", "4"))
+REDIS_POOL_TIMEOUT_SECONDS = float(os.environ.get("REDIS_POOL_TIMEOUT_SECONDS", "5"))
+REDIS_SOCKET_TIMEOUT_SECONDS = float(os.environ.get("REDIS_SOCKET_TIMEOUT_SECONDS", "5"))
+REDIS_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("REDIS_CONNECT_TIMEOUT_SECONDS", "2"))
+# TCP keepalive idle time; 0 turns keepalive off.
+REDIS_KEEPALIVE_SECONDS = int(os.environ.get("REDIS_KEEPALIVE_SECONDS", "60"))
+REDIS_HEALTH_CHECK_SECONDS = int(os.environ.get("REDIS_HEALTH_CHECK_SECONDS", "30"))
+REDIS_RETRIES = int(os.environ.get("REDIS_RETRIES", "3"))
+REDIS_RETRY_BACKOFF_MS = float(os.environ.get("REDIS_RETRY_BACKOFF_MS", "50"))
+REDIS_RETRY_BACKOFF_CAP_MS = float(os.environ.get("REDIS_RETRY_BACKOFF_CAP_MS", "1000"))
+
+
+def redis_options(host=REDIS_HOST, port=REDIS_PORT, retry_class=Retry):
+    """Connection settings shared by every Redis client of both engines."""
+    options = {
+        "host": host,
+        "port": port,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT_SECONDS,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT_SECONDS,
+        "health_check_interval": REDIS_HEALTH_CHECK_SECONDS,
+        "retry": retry_class(
+            ExponentialBackoff(REDIS_RETRY_BACKOFF_CAP_MS / 1000, REDIS_RETRY_BACKOFF_MS / 1000),
+            REDIS_RETRIES,
+        ),
+        "retry_on_error": [redis.ConnectionError, redis.TimeoutError],
+    }
+    # A cluster only has database 0.
+    if not REDIS_CLUSTER:
+        options["db"] = REDIS_DB
+    if REDIS_KEEPALIVE_SECONDS > 0:
+        options["socket_keepalive"] = True
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            options["socket_keepalive_options"] = {
+                socket.TCP_KEEPIDLE: REDIS_KEEPALIVE_SECONDS,
+                socket.TCP_KEEPINTVL: max(1, REDIS_KEEPALIVE_SECONDS // 4),
+                socket.TCP_KEEPCNT: 4,
+            }
+    return options
+
+
+class PoolMeter:
+    """Saturation counters for one connection pool: connections checked out
+    now and at peak, checkouts that found the pool exhausted and had to wait
+    (waits) and those that gave up after REDIS_POOL_TIMEOUT_SECONDS
+    (timeouts).
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.requested = 0
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        with self.lock:
+            self.requested += 1
+            if self.requested > self.size:
+                self.waits += 1
+
+    def acquired(self):
+        with self.lock:
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+
+    def failed(self, timed_out):
+        with self.lock:
+            self.requested -= 1
+            if timed_out:
+                self.timeouts += 1
+
+    def released(self):
+        with self.lock:
+            self.requested -= 1
+            self.in_use -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "size": self.size,
+                "in_use": self.in_use,
+                "peak": self.peak,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+            }
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+
+    def __init__(self, meter, **kwargs):
+        super().__init__(max_connections=meter.size, timeout=REDIS_POOL_TIMEOUT_SECONDS, **kwargs)
+        self.meter = meter
+        # connection -> (command, checkout time). The base class also
+        # releases connections that failed to connect, which were never
+        # handed out.
+        self.checked_out = {}
+
+    def get_connection(self, command_name, *keys, **options):
+        self.meter.checkout()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except BaseException as e:
+            self.meter.failed(isinstance(e, redis.ConnectionError) and str(e) == "No connection available.")
+            raise
+        self.checked_out[connection] = (command_name, time.perf_counter())
+        self.meter.acquired()
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        checkout = self.checked_out.pop(connection, None)
+        if checkout is not None:
+            command_name, start = checkout
+            redis_seconds.observe(time.perf_counter() - start, command_name.upper())
+            self.meter.released()
+
+
+pool_meters = {
+    "publish": PoolMeter("publish", REDIS_PUBLISH_POOL_SIZE),
+    "control": PoolMeter("control", REDIS_CONTROL_POOL_SIZE),
+    "heartbeat": PoolMeter("heartbeat", REDIS_HEARTBEAT_POOL_SIZE),
+}
+
+
+def metered_client(workload, host=REDIS_HOST, port=REDIS_PORT):
+    pool = MeteredConnectionPool(
+        pool_meters[workload], decode_responses=True, **redis_options(host, port)
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+# In cluster mode every key except room history carries the {chat} hash tag,
+# so Lua scripts, MULTI and pipelines over them stay on one shard and work
+# unchanged.
+CLUSTER_TAG = "{chat}:" if REDIS_CLUSTER else ""
+
+if REDIS_CLUSTER:
+    # Room publishes and history go through the cluster client, spread by
+    # room name. RedisCluster builds one pool per node; those are not metered.
+    del pool_meters["publish"]
+    publish_client = redis.RedisCluster(decode_responses=True, **redis_options())
+    # The control state lives on the shard that owns the tag; see
+    # follow_control_node for when that slot moves.
+    control_node = publish_client.get_node_from_key(CLUSTER_TAG)
+    redis_client = metered_client("control", control_node.host, control_node.port)
+    heartbeat_client = metered_client("heartbeat", control_node.host, control_node.port)
+else:
+    # Room and notification publishes, history appends.
+    publish_client = metered_client("publish")
+    # Logins, sessions, rooms, subscriptions.
+    redis_client = metered_client("control")
+    # Leases, presence, server liveness and reaping.
+    heartbeat_client = metered_client("heartbeat")
+
+# Pub/sub payloads are handed to clients as raw bytes, so the listener's
+# connection must not decode them.
+pubsub_client = (redis.RedisCluster if REDIS_CLUSTER else redis.Redis)(**redis_options())
+
+
+def control_slot_moved(error):
+    """Whether a Redis error means the {chat} slot may no longer be served
+    where the control clients point: MOVED after resharding, READONLY or a
+    lost connection after a failover. Pipelines wrap the MOVED reply in
+    their own message."""
+    return (isinstance(error, (redis.ConnectionError, redis.ReadOnlyError))
+            or "MOVED " in str(error))
+
+
+def follow_control_node():
+    """Cluster mode: re-read the slot map and, if the {chat} slot moved,
+    point the control and heartbeat clients at its new owner.
+
+    The clients keep their identity (registered scripts are bound to them);
+    only their pools are replaced. Commands still running on the old pool
+    fail, as they would have anyway.
+    """
+    publish_client.nodes_manager.initialize()
+    node = publish_client.get_node_from_key(CLUSTER_TAG)
+    current = redis_client.connection_pool.connection_kwargs
+    if (current["host"], current["port"]) == (node.host, node.port):
+        return False
+    print(f"Control slot moved from {current['host']}:{current['port']} to {node.host}:{node.port}")
+    for client, workload in ((redis_client, "control"), (heartbeat_client, "heartbeat")):
+        old_pool = client.connection_pool
+        client.connection_pool = metered_client(workload, node.host, node.port).connection_pool
+        old_pool.disconnect()
+    return True
+
+
+def recover_control_node(error):
+    """Called with Redis errors seen by the heartbeat."""
+    if not REDIS_CLUSTER or not control_slot_moved(error):
+        return
+    try:
+        follow_control_node()
+    except redis.RedisError as e:
+        print(f"Cluster slot map refresh failed: {e}")
+
+
+def check_sharded_pubsub():
+    """SSUBSCRIBE/SPUBLISH need Redis 7; fail at startup rather than on the
+    first room message."""
+    if REDIS_CLUSTER:
+        infos = publish_client.info("server", target_nodes=redis.RedisCluster.ALL_NODES).values()
+    else:
+        infos = [redis_client.info("server")]
+    for info in infos:
+        version = info["redis_version"]
+        if int(version.split(".")[0]) < 7:
+            raise SystemExit(f"Sharded pub/sub needs Redis 7 or later; found {version}")
+
+
+def format_pool_stats(meters):
+    return "Redis pools: " + " ".join(
+        f"{m['name']}={m['in_use']}/{m['size']} (peak={m['peak']} waits={m['waits']} "
+        f"timeouts={m['timeouts']})"
+        for m in (meter.stats() for meter in meters)
+    ) + "\n"
+
+
+class Session:
+    """One logged-in connection.
+
+    The room and subscriber indexes hold Session references, so fan-out
+    reads the writer straight off the session, and teardown only visits
+    the session's room and its own subscriptions.
+    """
+
+    __slots__ = ("conn", "user", "room", "subscriptions", "outbound", "leased", "resume_token",
+                 "bucket", "limited")
+
+    def __init__(self, conn, user, outbound=None):
+        self.conn = conn
+        self.user = user
+        self.room = MAIN_ROOM
+        # Users this session receives /publish notifications from.
+        self.subscriptions = set()
+        self.outbound = outbound
+        # False once the lease is taken over or the session is ending; the
+        # heartbeat only refreshes leased sessions.
+        self.leased = True
+        # Set by drain_sessions: hand the session off instead of ending it.
+        self.resume_token = None
+        # Lines this connection may send, created by connection_take on the
+        # first line; only its session thread takes.
+        self.bucket = None
+        self.limited = 0
+
+
+sessions = set()
+room_sessions = {MAIN_ROOM: set()}
 subscribers = {}
-subscriptions = {}
-active_users_local = set()
-
-state_lock = threading.Lock()
-
+# publisher -> tuple of subscribers[publisher], built on the first
+# notification and dropped whenever the set changes, so a popular
+# publisher's followers are not copied for every message.
+subscriber_snapshots = {}
+
+# Locking:
+#   room_sessions[room]        -> room_lock(room)
+#   subscribers[publisher]     -> subscriber_lock(publisher)
+#   subscriber_snapshots       -> subscriber_lock(publisher)
+#   sessions, Session.leased   -> sessions_lock
+# A session's room and subscriptions are only touched by its own session
+# thread and need no lock. Locks are never nested and no Redis call is
+# made while holding one.
+room_locks = [metrics.TimedLock(lock_wait_seconds, "room") for _ in range(LOCK_STRIPES)]
+subscriber_locks = [metrics.TimedLock(lock_wait_seconds, "subscriber") for _ in range(LOCK_STRIPES)]
+sessions_lock = metrics.TimedLock(lock_wait_seconds, "sessions")
+
+# (action, channel) pairs applied by the pub/sub listener thread, which owns
+# the pub/sub connection. Enqueued while holding the room/subscriber lock so
+# the order matches the order in which the local sets were created and
+# emptied.
+channel_changes = queue.Queue()
+
+# (followers, data) notifications for start_notification_delivery.
+notification_deliveries = queue.Queue()
+
+# Clients send bcrypt(password, SHARED_SALT). The server stores that value
+# hashed again with a per-user salt in credentials:<user>.
 SHARED_SALT = b"$2b$12$abcdefghijklmnopqrstuu"
 
 
@@ -46,105 +468,914 @@ def hash_password(pwd):
     return bcrypt.hashpw(pwd.encode(), SHARED_SALT).decode()
 
 
+class VerificationCache:
+    """LRU of recent successful logins, so reconnect storms skip bcrypt.
+
+    Entries are digests of (user, client hash, stored hash): a password
+    change invalidates them, and the cache never holds a usable credential.
+    """
+
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(user, client_hash, stored_hash):
+        return hashlib.sha256(f"{user}\0{client_hash}\0{stored_hash}".encode()).digest()
+
+    def get(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None or expires < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl_seconds
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"hit": self.hits, "miss": self.misses}
+
+
+class AdmissionController:
+    """Token-bucket accept rate plus a cap on connections in the TLS
+    handshake or login verification phase.
+
+    Connections over the rate wait in the listen backlog (deferred);
+    connections over the cap get a busy reply (rejected).
+    """
+
+    def __init__(self, rate, burst, max_pending):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.deferred = 0
+        self.rejected = 0
+
+    def reserve(self, max_wait=None):
+        """Take an accept token; return seconds to wait before using it, or
+        None (counted as rejected) if that would be longer than max_wait."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            wait = (1 - self.tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                self.rejected += 1
+                return None
+            self.tokens -= 1
+            self.deferred += 1
+            return wait
+
+    def admit(self):
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            self.rejected += 1
+        return False
+
+    def release(self):
+        self.slots.release()
+
+    def record_accepted(self):
+        with self.lock:
+            self.accepted += 1
+
+    def retry_after(self):
+        # Jittered so rejected clients do not all come back in the same second.
+        return ADMISSION_RETRY_SECONDS + random.randint(0, ADMISSION_RETRY_SECONDS)
+
+    def busy_message(self):
+        return f"Server busy, retry after {self.retry_after()} seconds\n"
+
+    def stats(self):
+        with self.lock:
+            return {
+                "accepted": self.accepted,
+                "deferred": self.deferred,
+                "rejected": self.rejected,
+            }
+
+
+admission = AdmissionController(ACCEPT_RATE, ACCEPT_BURST, MAX_PENDING_LOGINS)
+
+verification_cache = VerificationCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+# bcrypt releases the GIL; a bounded pool keeps at most AUTH_WORKERS hashes
+# running no matter how many clients log in at once.
+auth_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+
+
 def room_key(room):
+    return f"{CLUSTER_TAG}room:{room}"
+
+
+def room_channel(room):
     return f"room:{room}"
 
 
 def session_key(user):
-    return f"session:{user}"
+    return f"{CLUSTER_TAG}session:{user}"
 
 
 def active_key(user):
-    return f"active:{user}"
+    return f"{CLUSTER_TAG}active:{user}"
 
 
 def subscriptions_key(user):
-    return f"subscriptions:{user}"
+    return f"{CLUSTER_TAG}subscriptions:{user}"
 
 
 def subscribers_key(user):
-    return f"subscribers:{user}"
+    return f"{CLUSTER_TAG}subscribers:{user}"
 
 
 def notify_key(user):
     return f"notify:{user}"
 
 
-def online_users_key():
-    return "online_users"
+def credentials_key(user):
+    return f"{CLUSTER_TAG}credentials:{user}"
 
 
-# KEYS: [room_set_key, rooms_index_key], ARGV: [room_name]
-REMOVE_ROOM_IF_EMPTY_SCRIPT = """
-if redis.call('scard', KEYS[1]) == 0 then
-    redis.call('del', KEYS[1])
-    redis.call('srem', KEYS[2], ARGV[1])
-    return 1
+def presence_key():
+    return f"{CLUSTER_TAG}presence"
+
+
+def node_key(server_id):
+    return f"{CLUSTER_TAG}server:{server_id}"
+
+
+# Sorted set of server ids scored by liveness expiry, so reapers find dead
+# servers without scanning keys.
+def nodes_key():
+    return f"{CLUSTER_TAG}servers"
+
+
+def node_sessions_key(server_id):
+    return f"{CLUSTER_TAG}server_sessions:{server_id}"
+
+
+# Pub/sub channel for presence changes: newline separated "+user" / "-user".
+def presence_channel():
+    return "presence_events"
+
+
+def rooms_key():
+    return f"{CLUSTER_TAG}rooms"
+
+
+def room_occupancy_key():
+    return f"{CLUSTER_TAG}room_occupancy"
+
+
+def history_key(room):
+    if REDIS_CLUSTER:
+        # Each room's stream goes to the shard of its own name.
+        return f"history:{{{room}}}"
+    return f"history:{room}"
+
+
+def inbox_key(user):
+    return f"{CLUSTER_TAG}inbox:{user}"
+
+
+# Hash {token, room} of a session handed off by a draining server.
+def resume_key(user):
+    return f"{CLUSTER_TAG}resume:{user}"
+
+
+# Removes the user from the room, keeps room_occupancy (room -> member count)
+# in step, and drops the room from the indexes once it is empty unless
+# keep_if_empty is "1" (the lobby). Shared by the scripts below.
+REMOVE_FROM_ROOM_LUA = """
+local function remove_from_room(room_set, rooms_index, occupancy, room, user, keep_if_empty)
+    if redis.call('srem', room_set, user) == 1 then
+        redis.call('zincrby', occupancy, -1, room)
+    end
+    if keep_if_empty ~= '1' and redis.call('scard', room_set) == 0 then
+        redis.call('del', room_set)
+        redis.call('srem', rooms_index, room)
+        redis.call('zrem', occupancy, room)
+        return 1
+    end
+    return 0
 end
-return 0
 """
 
-# KEYS: [rooms_index_key, room_set_key, session_key], ARGV: [user, room, server_id]
+# KEYS: [room_set_key, rooms_index_key, room_occupancy_key], ARGV: [room_name, user, keep_if_empty]
+REMOVE_ROOM_IF_EMPTY_SCRIPT = REMOVE_FROM_ROOM_LUA + """
+return remove_from_room(KEYS[1], KEYS[2], KEYS[3], ARGV[1], ARGV[2], ARGV[3])
+"""
+
+# KEYS: [node_sessions_key, rooms_index_key, room_occupancy_key, nodes_key]
+# ARGV: [dead_server_id, batch_size, main_room, session_prefix, room_prefix]
+# Pops up to batch_size users of a dead server and, for those whose session
+# still points at it (not reconnected elsewhere), removes them from their
+# room and deletes the session. Forgets the server once its set is empty.
+# Returns {reaped, remaining}.
+REAP_NODE_SCRIPT = REMOVE_FROM_ROOM_LUA + """
+local reaped = 0
+for _, user in ipairs(redis.call('spop', KEYS[1], ARGV[2])) do
+    local session = ARGV[4] .. user
+    local fields = redis.call('hmget', session, 'room', 'server')
+    if fields[2] == ARGV[1] then
+        if fields[1] then
+            local keep = '0'
+            if fields[1] == ARGV[3] then
+                keep = '1'
+            end
+            remove_from_room(ARGV[5] .. fields[1], KEYS[2], KEYS[3], fields[1], user, keep)
+        end
+        redis.call('del', session)
+        reaped = reaped + 1
+    end
+end
+local remaining = redis.call('scard', KEYS[1])
+if remaining == 0 then
+    redis.call('zrem', KEYS[4], ARGV[1])
+end
+return {reaped, remaining}
+"""
+
+# KEYS: [rooms_index_key, room_set_key, session_key, room_occupancy_key], ARGV: [user, room, server_id]
 ADD_USER_TO_ROOM_SCRIPT = """
 redis.call('sadd', KEYS[1], ARGV[2])
-redis.call('sadd', KEYS[2], ARGV[1])
+if redis.call('sadd', KEYS[2], ARGV[1]) == 1 then
+    redis.call('zincrby', KEYS[4], 1, ARGV[2])
+end
 redis.call('hset', KEYS[3], 'room', ARGV[2], 'server', ARGV[3])
 return 1
 """
 
-# KEYS: [active_key], ARGV: [server_id, ttl_seconds]
-REFRESH_ACTIVE_USER_SCRIPT = """
-if redis.call('get', KEYS[1]) == ARGV[1] then
-    redis.call('set', KEYS[1], ARGV[1], 'XX', 'EX', ARGV[2])
-    return 1
+# KEYS: [presence_key, active_key, ...]
+# ARGV: [server_id, ttl_seconds, expires_at, presence_channel, user, ...]
+# Extends the leases that are still ours and their presence scores; a user
+# that had been pruned from presence is announced again. Returns the 1-based
+# positions of the users whose lease is no longer ours.
+REFRESH_ACTIVE_USERS_SCRIPT = """
+local lost = {}
+local joined = {}
+for i = 2, #KEYS do
+    local user = ARGV[i + 3]
+    if redis.call('get', KEYS[i]) == ARGV[1] then
+        redis.call('expire', KEYS[i], ARGV[2])
+        if redis.call('zadd', KEYS[1], ARGV[3], user) == 1 then
+            joined[#joined + 1] = '+' .. user
+        end
+    else
+        lost[#lost + 1] = i - 1
+    end
 end
-return 0
+if #joined > 0 then
+    redis.call('publish', ARGV[4], table.concat(joined, '\\n'))
+end
+return lost
 """
 
-# KEYS: [active_key], ARGV: [server_id]
+# KEYS: [active_key, presence_key], ARGV: [server_id, user, presence_channel]
 RELEASE_ACTIVE_USER_SCRIPT = """
 if redis.call('get', KEYS[1]) == ARGV[1] then
     redis.call('del', KEYS[1])
+    redis.call('zrem', KEYS[2], ARGV[2])
+    redis.call('publish', ARGV[3], '-' .. ARGV[2])
     return 1
 end
 return 0
 """
 
+# KEYS: [presence_key], ARGV: [now, presence_channel, limit]
+# Drops users whose lease expired without a release (crashed node) and
+# announces them. Returns how many were pruned.
+PRUNE_PRESENCE_SCRIPT = """
+local expired = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+if #expired == 0 then
+    return 0
+end
+redis.call('zrem', KEYS[1], unpack(expired))
+local events = {}
+for i, user in ipairs(expired) do
+    events[i] = '-' .. user
+end
+redis.call('publish', ARGV[2], table.concat(events, '\\n'))
+return #expired
+"""
+
+# KEYS: [subscribers_key]
+# ARGV: [notify_channel, envelope, inbox_line, inbox_length, inbox_ttl, inbox_prefix, active_prefix]
+# Publishes the envelope for online subscribers and appends the line to the
+# inbox of every subscriber without an active lease. Returns the number of
+# inboxes written.
+PUBLISH_NOTIFICATION_SCRIPT = """
+redis.call('publish', ARGV[1], ARGV[2])
+local stored = 0
+for _, user in ipairs(redis.call('smembers', KEYS[1])) do
+    if redis.call('exists', ARGV[7] .. user) == 0 then
+        local inbox = ARGV[6] .. user
+        redis.call('rpush', inbox, ARGV[3])
+        redis.call('ltrim', inbox, -tonumber(ARGV[4]), -1)
+        redis.call('expire', inbox, ARGV[5])
+        stored = stored + 1
+    end
+end
+return stored
+"""
+
+# KEYS: [resume_key, active_key], ARGV: [token, server_id, ttl_seconds]
+# Consumes the resume record and takes the lease if the token matches and the
+# user is not logged in elsewhere. Returns the room, or nil.
+RESUME_SESSION_SCRIPT = """
+if redis.call('hget', KEYS[1], 'token') ~= ARGV[1] then
+    return false
+end
+if not redis.call('set', KEYS[2], ARGV[2], 'NX', 'EX', ARGV[3]) then
+    return false
+end
+local room = redis.call('hget', KEYS[1], 'room')
+redis.call('del', KEYS[1])
+return room
+"""
+
+# KEYS: [bucket_key, ...], ARGV: [rate, burst, ttl_seconds, taken, ...]
+# Refills each shared token bucket on the Redis clock, takes the tokens
+# taken on one server since its last sync and returns the balances. A
+# balance may go negative when servers together overspent.
+RATE_LIMIT_SYNC_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local balances = {}
+for i, key in ipairs(KEYS) do
+    local state = redis.call('hmget', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate) - tonumber(ARGV[i + 3])
+    redis.call('hset', key, 'tokens', tokens, 'updated', now)
+    redis.call('expire', key, ARGV[3])
+    balances[i] = tostring(tokens)
+end
+return balances
+"""
+
 remove_room_if_empty_script = redis_client.register_script(REMOVE_ROOM_IF_EMPTY_SCRIPT)
 add_user_to_room_script = redis_client.register_script(ADD_USER_TO_ROOM_SCRIPT)
-refresh_active_user_script = redis_client.register_script(REFRESH_ACTIVE_USER_SCRIPT)
+refresh_active_users_script = heartbeat_client.register_script(REFRESH_ACTIVE_USERS_SCRIPT)
 release_active_user_script = redis_client.register_script(RELEASE_ACTIVE_USER_SCRIPT)
+prune_presence_script = heartbeat_client.register_script(PRUNE_PRESENCE_SCRIPT)
+reap_node_script = heartbeat_client.register_script(REAP_NODE_SCRIPT)
+publish_notification_script = publish_client.register_script(PUBLISH_NOTIFICATION_SCRIPT)
+resume_session_script = redis_client.register_script(RESUME_SESSION_SCRIPT)
+rate_limit_sync_script = redis_client.register_script(RATE_LIMIT_SYNC_SCRIPT)
+
+scripts = [
+    remove_room_if_empty_script,
+    add_user_to_room_script,
+    refresh_active_users_script,
+    release_active_user_script,
+    prune_presence_script,
+    reap_node_script,
+    publish_notification_script,
+    resume_session_script,
+    rate_limit_sync_script,
+]
+
+
+def load_scripts():
+    # Scripts queued in a pipeline are not reloaded after NOSCRIPT on a
+    # cluster, so every primary gets them up front.
+    for script in scripts:
+        script.registered_client.script_load(script.script)
+
+
+def publish_room(client, room, envelope):
+    """PUBLISH (or SPUBLISH) envelope on the room's channel via client, which
+    may be a pipeline."""
+    if REDIS_SHARDED_PUBSUB:
+        return client.spublish(room_channel(room), envelope)
+    return client.publish(room_channel(room), envelope)
+
+
+def add_user_to_room(user, room, client=None):
+    add_user_to_room_script(
+        keys=[rooms_key(), room_key(room), session_key(user), room_occupancy_key()],
+        args=[user, room, SERVER_ID],
+        client=client
+    )
 
 
-def add_user_to_room(user, room):
-    add_user_to_room_script(keys=["rooms", room_key(room), session_key(user)], args=[user, room, SERVER_ID])
-
-
-def remove_user_from_room(user, room):
-    redis_client.srem(room_key(room), user)
-    if room != MAIN_ROOM:
-        remove_room_if_empty_script(keys=[room_key(room), "rooms"], args=[room])
+def remove_user_from_room(user, room, client=None):
+    remove_room_if_empty_script(
+        keys=[room_key(room), rooms_key(), room_occupancy_key()],
+        args=[room, user, "1" if room == MAIN_ROOM else "0"],
+        client=client
+    )
 
 
-def publish_room_message(room, text, sender=None):
-    payload = {
-        "type": "room_message",
+def append_history(pipe, room, entries):
+    """Queue one XADD per (sender, text) on pipe. The stream is trimmed to
+    about HISTORY_LENGTH entries and expires HISTORY_TTL_SECONDS after its
+    last message, so abandoned rooms do not keep theirs forever."""
+    key = history_key(room)
+    for sender, text in entries:
+        pipe.xadd(key, {"sender": sender or "", "text": text}, maxlen=HISTORY_LENGTH, approximate=True)
+    pipe.expire(key, HISTORY_TTL_SECONDS)
+
+
+def history_enabled():
+    return HISTORY_LENGTH > 0 and HISTORY_BACKFILL > 0
+
+
+def history_lines(entries):
+    # XREVRANGE returns newest first.
+    return [fields.get("text", "") for _, fields in reversed(entries)]
+
+
+def format_history(room, lines):
+    return f"--- last {len(lines)} messages in {room} ---\n" + "".join(lines)
+
+
+def init_room_index():
+    redis_client.sadd(rooms_key(), MAIN_ROOM)
+    redis_client.zadd(room_occupancy_key(), {MAIN_ROOM: 0}, nx=True)
+    # Deployments that predate room_occupancy: build it once from the sets.
+    if redis_client.zcard(room_occupancy_key()) < redis_client.scard(rooms_key()):
+        rooms = list(redis_client.smembers(rooms_key()))
+        pipe = redis_client.pipeline(transaction=False)
+        for r in rooms:
+            pipe.scard(room_key(r))
+        counts = pipe.execute()
+        redis_client.zadd(room_occupancy_key(), dict(zip(rooms, counts)))
+
+
+rooms_cache = {"expires": 0.0, "rooms": []}
+rooms_cache_lock = threading.Lock()
+
+
+def room_listing():
+    """All rooms as (name, member_count), sorted by name.
+
+    One ZRANGE per ROOMS_CACHE_TTL_SECONDS per node, however many rooms.
+    """
+    with rooms_cache_lock:
+        if time.monotonic() < rooms_cache["expires"]:
+            return rooms_cache["rooms"]
+    entries = redis_client.zrange(room_occupancy_key(), 0, -1, withscores=True)
+    rooms = sorted((r, int(count)) for r, count in entries)
+    with rooms_cache_lock:
+        rooms_cache["rooms"] = rooms
+        rooms_cache["expires"] = time.monotonic() + ROOMS_CACHE_TTL_SECONDS
+    return rooms
+
+
+def parse_count(text, maximum):
+    """text as a whole number from 1 to maximum, or None."""
+    if not (text.isascii() and text.isdigit()) or len(text) > len(str(maximum)):
+        return None
+    value = int(text)
+    return value if 1 <= value <= maximum else None
+
+
+def format_room_listing(rooms, argument=""):
+    """Reply to "/rooms", "/rooms <page>" or "/rooms top [n]"."""
+    parts = argument.split()
+    pages = max(1, -(-len(rooms) // ROOMS_PAGE_SIZE))
+    usage = (f"Usage: /rooms [page] or /rooms top [n], page from 1 to {pages}, "
+             f"n from 1 to {ROOMS_PAGE_SIZE}\n")
+    if parts and parts[0] == "top":
+        limit = parse_count(parts[1], ROOMS_PAGE_SIZE) if len(parts) == 2 else 10
+        if limit is None or len(parts) > 2:
+            return usage
+        top = sorted(rooms, key=lambda entry: (-entry[1], entry[0]))[:limit]
+        listing = ", ".join(f"{r}({c})" for r, c in top)
+        return f"Top rooms: {listing}\n"
+
+    page = parse_count(parts[0], pages) if len(parts) == 1 else 1
+    if page is None or len(parts) > 1:
+        return usage
+    start = (page - 1) * ROOMS_PAGE_SIZE
+    listing = ", ".join(f"{r}({c})" for r, c in rooms[start:start + ROOMS_PAGE_SIZE])
+    if pages == 1 and page == 1:
+        return f"Available rooms: {listing}\n"
+    return f"Available rooms (page {page}/{pages}): {listing}\n"
+
+
+# Binary envelope: header, then target, sender, origin and body as utf-8,
+# back to back. The magic byte can never start a JSON document, so nodes
+# accept both formats regardless of their own ENVELOPE_FORMAT.
+ENVELOPE_MAGIC = b"\xce"
+ENVELOPE_HEADER = struct.Struct("!cBdHHHI")
+ENVELOPE_TYPES = {"room_message": 1, "notify_message": 2, "room_batch": 3}
+ENVELOPE_TYPE_NAMES = {code: name for name, code in ENVELOPE_TYPES.items()}
+
+
+# A room_batch body is a sequence of these records, each followed by the
+# sender and the text.
+BATCH_RECORD = struct.Struct("!HI")
+
+
+def encode_envelope(payload_type, target, body, sender=None):
+    if ENVELOPE_FORMAT == "binary":
+        fields = [f if isinstance(f, bytes) else f.encode() for f in (target, sender or "", SERVER_ID, body)]
+        header = ENVELOPE_HEADER.pack(
+            ENVELOPE_MAGIC, ENVELOPE_TYPES[payload_type], time.time(), *(len(f) for f in fields)
+        )
+        return header + b"".join(fields)
+
+    if payload_type == "room_message":
+        payload = {
+            "type": "room_message",
+            "room": target,
+            "text": body,
+            "sender": sender,
+            "origin": SERVER_ID,
+            "sent_at": time.time()
+        }
+    else:
+        payload = {
+            "type": "notify_message",
+            "publisher": target,
+            "message": body,
+            "origin": SERVER_ID,
+            "sent_at": time.time()
+        }
+    return json.dumps(payload)
+
+
+def encode_batch_envelope(room, messages):
+    """One envelope for several (sender, text) messages to the same room."""
+    if ENVELOPE_FORMAT == "binary":
+        records = []
+        for sender, text in messages:
+            sender_bytes = (sender or "").encode()
+            text_bytes = text.encode()
+            records += (BATCH_RECORD.pack(len(sender_bytes), len(text_bytes)), sender_bytes, text_bytes)
+        return encode_envelope("room_batch", room, b"".join(records))
+
+    return json.dumps({
+        "type": "room_batch",
         "room": room,
-        "text": text,
-        "sender": sender,
-        "origin": SERVER_ID
+        "messages": messages,
+        "origin": SERVER_ID,
+        "sent_at": time.time()
+    })
+
+
+def decode_batch(body):
+    messages = []
+    offset = 0
+    while offset < len(body):
+        sender_len, text_len = BATCH_RECORD.unpack_from(body, offset)
+        offset += BATCH_RECORD.size
+        sender = str(body[offset:offset + sender_len], "utf-8") or None
+        offset += sender_len
+        messages.append((sender, body[offset:offset + text_len]))
+        offset += text_len
+    return messages
+
+
+def decode_envelope(data):
+    """Return (type, target, sender, origin, sent_at, body) or None.
+
+    body is a memoryview of the utf-8 encoded text, ready to be shared by
+    every local recipient without further copies. For room_batch it is a
+    list of (sender, memoryview) instead.
+    """
+    try:
+        if data[:1] == ENVELOPE_MAGIC:
+            _, type_code, sent_at, target_len, sender_len, origin_len, body_len = ENVELOPE_HEADER.unpack_from(data)
+            view = memoryview(data)
+            offset = ENVELOPE_HEADER.size
+            fields = []
+            for length in (target_len, sender_len, origin_len):
+                fields.append(str(view[offset:offset + length], "utf-8"))
+                offset += length
+            target, sender, origin = fields
+            body = view[offset:offset + body_len]
+            if type_code == ENVELOPE_TYPES["room_batch"]:
+                body = decode_batch(body)
+            return ENVELOPE_TYPE_NAMES[type_code], target, sender or None, origin, sent_at, body
+
+        payload = json.loads(data)
+        payload_type = payload.get("type")
+        if payload_type == "room_message":
+            return (
+                payload_type,
+                payload.get("room"),
+                payload.get("sender"),
+                payload.get("origin"),
+                payload.get("sent_at", 0.0),
+                memoryview(payload.get("text").encode())
+            )
+        if payload_type == "notify_message":
+            return (
+                payload_type,
+                payload.get("publisher"),
+                None,
+                payload.get("origin"),
+                payload.get("sent_at", 0.0),
+                memoryview(payload.get("message").encode())
+            )
+        if payload_type == "room_batch":
+            return (
+                payload_type,
+                payload.get("room"),
+                None,
+                payload.get("origin"),
+                payload.get("sent_at", 0.0),
+                [(sender, memoryview(text.encode())) for sender, text in payload.get("messages")]
+            )
+    except Exception:
+        pass
+    return None
+
+
+def publish_room_message(room, text, sender=None, record=False):
+    messages_published.inc()
+    if COALESCE_WINDOW_MS > 0:
+        coalescer.add(room, text, sender, record)
+        return
+    envelope = encode_envelope("room_message", room, text, sender)
+    if record and HISTORY_LENGTH > 0:
+        pipe = publish_client.pipeline(transaction=False)
+        publish_room(pipe, room, envelope)
+        append_history(pipe, room, [(sender, text)])
+        pipe.execute()
+        return
+    publish_room(publish_client, room, envelope)
+
+
+class RoomCoalescer:
+    """Holds room messages for up to COALESCE_WINDOW_MS (less once a room
+    has COALESCE_MAX_BYTES queued) and publishes each room's batch as one
+    envelope, all rooms in one pipeline. Only the flusher thread publishes,
+    so a room's messages keep their order.
+    """
+
+    def __init__(self, window_seconds, max_bytes):
+        self.window_seconds = window_seconds
+        self.max_bytes = max_bytes
+        self.pending = {}
+        self.history = {}
+        self.sizes = {}
+        self.full = False
+        self.cond = threading.Condition()
+        self.messages = 0
+        self.publishes = 0
+
+    def add(self, room, text, sender=None, record=False):
+        with self.cond:
+            self.pending.setdefault(room, []).append((sender, text))
+            if record and HISTORY_LENGTH > 0:
+                self.history.setdefault(room, []).append((sender, text))
+            size = self.sizes.get(room, 0) + len(text)
+            self.sizes[room] = size
+            if size >= self.max_bytes:
+                self.full = True
+            self.cond.notify()
+
+    def take(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending)
+            self.cond.wait_for(lambda: self.full, timeout=self.window_seconds)
+            pending, history = self.pending, self.history
+            self.pending = {}
+            self.history = {}
+            self.sizes = {}
+            self.full = False
+            return pending, history
+
+    def flush(self, pending, history):
+        pipe = publish_client.pipeline(transaction=False)
+        for room, messages in pending.items():
+            if len(messages) == 1:
+                sender, text = messages[0]
+                publish_room(pipe, room, encode_envelope("room_message", room, text, sender))
+            else:
+                publish_room(pipe, room, encode_batch_envelope(room, messages))
+        for room, entries in history.items():
+            append_history(pipe, room, entries)
+        pipe.execute()
+        with self.cond:
+            self.messages += sum(len(messages) for messages in pending.values())
+            self.publishes += len(pending)
+
+    def stats(self):
+        with self.cond:
+            return {"message": self.messages, "publish": self.publishes}
+
+    def run(self):
+        while True:
+            pending, history = self.take()
+            try:
+                self.flush(pending, history)
+            except redis.RedisError as e:
+                print(f"Coalesced publish error: {e}")
+
+
+coalescer = RoomCoalescer(COALESCE_WINDOW_MS / 1000, COALESCE_MAX_BYTES)
+
+
+class TokenBucket:
+    """rate tokens per second, up to burst. Not locked."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "taken")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # Tokens taken since the last sync (see RateLimiter).
+        self.taken = 0
+
+    def take(self):
+        """Take a token and return 0, or return the seconds until one will
+        be available and take nothing."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.taken += 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets by user or room, shared by all servers through Redis.
+
+    Tokens are taken locally, so a line costs no round-trip. Every
+    RATE_LIMIT_SYNC_SECONDS the tokens taken here go to Redis, all buckets
+    in one pipeline, and each local bucket is set to its cluster-wide
+    balance. Between syncs a server only spends what its own bucket refills,
+    so the cluster can overshoot a limit by about servers * rate * sync
+    interval. A user's bucket starts from its cluster balance (read with the
+    rest of the login state, see restore); a room bucket starts full, which
+    adds up to one burst per server. Full, idle buckets are forgotten.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def key(self, name):
+        return f"{CLUSTER_TAG}ratelimit:{self.name}:{name}"
+
+    def take(self, name):
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = TokenBucket(self.rate, self.burst)
+            return bucket.take()
+
+    def restore(self, name, state):
+        """Start name's local bucket from state, the [tokens, updated] read
+        from its Redis key. updated is Redis time; refilling from it assumes
+        synchronised clocks."""
+        tokens, updated = state
+        if self.rate <= 0 or tokens is None:
+            return
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = TokenBucket(self.rate, self.burst)
+            elapsed = max(0.0, time.time() - float(updated))
+            bucket.tokens = min(self.burst, float(tokens) + elapsed * self.rate) - bucket.taken
+            bucket.updated = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            taken = {}
+            now = time.monotonic()
+            for name, bucket in list(self.buckets.items()):
+                if bucket.taken:
+                    taken[name] = bucket.taken
+                    bucket.taken = 0
+                elif bucket.tokens + (now - bucket.updated) * self.rate >= self.burst:
+                    del self.buckets[name]
+        if not taken:
+            return
+        names = list(taken)
+        chunks = heartbeat_chunks(names)
+        # Expire once a bucket would have refilled anyway.
+        ttl = int(self.burst / self.rate + RATE_LIMIT_SYNC_SECONDS) + 1
+        pipe = redis_client.pipeline(transaction=False)
+        for chunk in chunks:
+            rate_limit_sync_script(
+                keys=[self.key(name) for name in chunk],
+                args=[self.rate, self.burst, ttl] + [taken[name] for name in chunk],
+                client=pipe,
+            )
+        try:
+            results = pipe.execute()
+        except redis.RedisError:
+            # Count them again next time.
+            with self.lock:
+                for name, count in taken.items():
+                    bucket = self.buckets.get(name)
+                    if bucket is not None:
+                        bucket.taken += count
+            raise
+        with self.lock:
+            now = time.monotonic()
+            for name, balance in zip(names, (b for result in results for b in result)):
+                bucket = self.buckets.get(name)
+                if bucket is not None:
+                    # Less what was taken here while the sync ran.
+                    bucket.tokens = float(balance) - bucket.taken
+                    bucket.updated = now
+
+    def stats(self):
+        with self.lock:
+            return len(self.buckets)
+
+
+user_limits = RateLimiter("user", RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST)
+room_limits = RateLimiter("room", RATE_LIMIT_ROOM_RATE, RATE_LIMIT_ROOM_BURST)
+
+
+def start_rate_limit_sync():
+    """Thread body; both engines run it."""
+    while True:
+        time.sleep(RATE_LIMIT_SYNC_SECONDS)
+        for limiter in (user_limits, room_limits):
+            try:
+                limiter.sync()
+            except redis.RedisError as e:
+                print(f"Rate limit sync error: {e}")
+
+
+def notification_line(publisher, message):
+    return f"Notification from {publisher}: {message}\n"
+
+
+def notification_script_args(publisher, message):
+    return {
+        "keys": [subscribers_key(publisher)],
+        "args": [
+            notify_key(publisher),
+            encode_envelope("notify_message", publisher, message),
+            notification_line(publisher, message),
+            INBOX_LENGTH,
+            INBOX_TTL_SECONDS,
+            inbox_key(""),
+            active_key(""),
+        ],
     }
-    redis_client.publish(room_key(room), json.dumps(payload))
 
 
 def publish_notification(publisher, message):
-    payload = {
-        "type": "notify_message",
-        "publisher": publisher,
-        "message": message,
-        "origin": SERVER_ID
-    }
-    redis_client.publish(notify_key(publisher), json.dumps(payload))
+    if INBOX_LENGTH <= 0:
+        publish_client.publish(notify_key(publisher), encode_envelope("notify_message", publisher, message))
+        return
+    publish_notification_script(**notification_script_args(publisher, message))
+
+
+def restore_session_state(user):
+    """Saved subscriptions and the drained inbox, in one MULTI round-trip
+    that also loads the user's rate limit balance."""
+    pipe = redis_client.pipeline()
+    pipe.smembers(subscriptions_key(user))
+    pipe.lrange(inbox_key(user), 0, -1)
+    pipe.delete(inbox_key(user))
+    pipe.hmget(user_limits.key(user), "tokens", "updated")
+    saved_subscriptions, inbox, _, limit_state = pipe.execute()
+    user_limits.restore(user, limit_state)
+    return set(saved_subscriptions), inbox
+
+
+def format_inbox(lines):
+    return f"--- {len(lines)} notifications while you were away ---\n" + "".join(lines)
 
 
 def set_active_user(user):
@@ -152,334 +1383,1195 @@ def set_active_user(user):
     )
 
 
-def refresh_active_user(user):
-    refreshed = refresh_active_user_script(keys=[active_key(user)], args=[SERVER_ID, ACTIVE_TTL_SECONDS])
-    return bool(refreshed)
+def refresh_active_users(users):
+    """Refresh the leases of users in one round-trip; return the lost ones.
+
+    Users are split into HEARTBEAT_BATCH_SIZE chunks so a single script run
+    never blocks Redis for long; all chunks go out in one pipeline.
+    """
+    users = list(users)
+    if not users:
+        return set()
+    chunks = heartbeat_chunks(users)
+    pipe = heartbeat_client.pipeline(transaction=False)
+    for chunk in chunks:
+        refresh_active_users_script(**refresh_script_args(chunk), client=pipe)
+    return lost_users(chunks, pipe.execute())
+
+
+def heartbeat_chunks(users):
+    return [users[i:i + HEARTBEAT_BATCH_SIZE] for i in range(0, len(users), HEARTBEAT_BATCH_SIZE)]
+
+
+def refresh_script_args(chunk):
+    return {
+        "keys": [presence_key()] + [active_key(u) for u in chunk],
+        "args": [SERVER_ID, ACTIVE_TTL_SECONDS, time.time() + ACTIVE_TTL_SECONDS, presence_channel()] + chunk,
+    }
+
+
+def lost_users(chunks, results):
+    lost = set()
+    for chunk, positions in zip(chunks, results):
+        lost.update(chunk[i - 1] for i in positions)
+    return lost
 
 
 def release_active_user(user):
-    release_active_user_script(keys=[active_key(user)], args=[SERVER_ID])
+    release_active_user_script(**release_script_args(user))
 
 
-def deliver_to_local(room, text, sender=None, origin=None):
-    with state_lock:
-        sockets = room_connections.get(room, set()).copy()
-        for s in sockets:
-            if sender and origin == SERVER_ID and connection_to_user.get(s) == sender:
-                continue
+def release_script_args(user):
+    return {
+        "keys": [active_key(user), presence_key()],
+        "args": [SERVER_ID, user, presence_channel()],
+    }
+
+
+def register_session(user, client=None):
+    """Index user under this server (for the reaper), add them to presence
+    (scored by lease expiry) and announce them."""
+    pipe = (client or redis_client).pipeline(transaction=False)
+    pipe.sadd(node_sessions_key(SERVER_ID), user)
+    pipe.zadd(presence_key(), {user: time.time() + ACTIVE_TTL_SECONDS})
+    pipe.publish(presence_channel(), f"+{user}")
+    return pipe
+
+
+def unregister_session(user, client=None):
+    pipe = (client or redis_client).pipeline(transaction=False)
+    pipe.delete(session_key(user))
+    pipe.srem(node_sessions_key(SERVER_ID), user)
+    return pipe
+
+
+def hand_off_session(user, room, token, client=None):
+    """Unregister user and store the resume record for its next server. The
+    caller adds the room removal and lease release to the same pipeline."""
+    pipe = unregister_session(user, client)
+    pipe.hset(resume_key(user), mapping={"token": token, "room": room})
+    pipe.expire(resume_key(user), RESUME_TTL_SECONDS)
+    return pipe
+
+
+def resume_script_args(user, token):
+    return {
+        "keys": [resume_key(user), active_key(user)],
+        "args": [token, SERVER_ID, ACTIVE_TTL_SECONDS],
+    }
+
+
+def reconnect_line(token):
+    """Sent last to a handed-off client: where and how to resume."""
+    if PEER_ADDRESSES:
+        return f"RECONNECT {token} {random.choice(PEER_ADDRESSES)}\n"
+    return f"RECONNECT {token}\n"
+
+
+def refresh_node(client=None):
+    pipe = (client or heartbeat_client).pipeline(transaction=False)
+    pipe.set(node_key(SERVER_ID), "1", ex=NODE_TTL_SECONDS)
+    pipe.zadd(nodes_key(), {SERVER_ID: time.time() + NODE_TTL_SECONDS})
+    return pipe
+
+
+def reap_script_args(server_id):
+    return {
+        "keys": [node_sessions_key(server_id), rooms_key(), room_occupancy_key(), nodes_key()],
+        "args": [server_id, REAPER_BATCH_SIZE, MAIN_ROOM, session_key(""), room_key("")],
+    }
+
+
+def reap_node(server_id):
+    """Reap all sessions of a dead server, REAPER_BATCH_SIZE per script run."""
+    total = 0
+    while True:
+        reaped, remaining = reap_node_script(**reap_script_args(server_id))
+        total += reaped
+        if not remaining:
+            return total
+
+
+def reap_dead_nodes():
+    # A server whose registry score has passed is only dead once its
+    # liveness key is gone too, which tolerates clock skew between servers.
+    for server_id in heartbeat_client.zrangebyscore(nodes_key(), "-inf", time.time()):
+        if server_id == SERVER_ID or heartbeat_client.exists(node_key(server_id)):
+            continue
+        reaped = reap_node(server_id)
+        print(f"Reaped {reaped} sessions of dead server {server_id}")
+
+
+def prune_script_args():
+    return {
+        "keys": [presence_key()],
+        "args": [time.time(), presence_channel(), PRESENCE_PRUNE_BATCH],
+    }
+
+
+class PresenceCache:
+    """Sorted snapshot of online users for /users.
+
+    Loaded in full from the presence set at most every
+    PRESENCE_RESYNC_SECONDS (which also repairs events missed while the
+    pub/sub connection was down); in between, presence events add and
+    remove single users.
+    """
+
+    def __init__(self):
+        self.users = []
+        self.members = set()
+        self.lock = threading.Lock()
+        self.synced_at = None
+
+    def stale(self):
+        return self.synced_at is None or time.monotonic() - self.synced_at > PRESENCE_RESYNC_SECONDS
+
+    def load(self, users):
+        with self.lock:
+            self.members = set(users)
+            self.users = sorted(self.members)
+            self.synced_at = time.monotonic()
+
+    def apply(self, events):
+        with self.lock:
+            for event in events.split("\n"):
+                op, user = event[:1], event[1:]
+                if op == "+" and user not in self.members:
+                    self.members.add(user)
+                    bisect.insort(self.users, user)
+                elif op == "-" and user in self.members:
+                    self.members.discard(user)
+                    del self.users[bisect.bisect_left(self.users, user)]
+
+    def page(self, prefix, page, page_size):
+        """Users starting with prefix: (the requested page, total matches)."""
+        with self.lock:
+            start = bisect.bisect_left(self.users, prefix)
+            end = bisect.bisect_left(self.users, prefix + "\U0010ffff") if prefix else len(self.users)
+            offset = start + (page - 1) * page_size
+            return self.users[offset:min(offset + page_size, end)], end - start
+
+
+presence_cache = PresenceCache()
+
+
+def sync_presence():
+    """Prune expired presence and reload the local snapshot if it is due."""
+    prune_presence_script(**prune_script_args())
+    if presence_cache.stale():
+        presence_cache.load(heartbeat_client.zrangebyscore(presence_key(), time.time(), "+inf"))
+
+
+def format_user_listing(argument=""):
+    """Reply to "/users [page]" or "/users <prefix> [page]". A lone number
+    is a page; "/users 42 1" searches for names starting with 42."""
+    parts = argument.split()
+    prefix = ""
+    if len(parts) == 2 or (len(parts) == 1 and not (parts[0].isascii() and parts[0].isdigit())):
+        prefix = parts.pop(0)
+    page = 1
+    if parts:
+        page = parse_count(parts[0], sys.maxsize) if len(parts) == 1 else None
+    users, total = presence_cache.page(prefix, page or 1, USERS_PAGE_SIZE)
+    pages = max(1, -(-total // USERS_PAGE_SIZE))
+    if page is None or page > pages:
+        return f"Usage: /users [page] or /users <prefix> [page], page from 1 to {pages}\n"
+    label = f"Users online matching {prefix}*" if prefix else "Users online"
+    listing = ", ".join(users)
+    if pages == 1 and page == 1:
+        return f"{label}: {listing}\n"
+    return f"{label} (page {page}/{pages}, {total} users): {listing}\n"
+
+
+def room_lock(room):
+    return room_locks[hash(room) % len(room_locks)]
+
+
+def subscriber_lock(publisher):
+    return subscriber_locks[hash(publisher) % len(subscriber_locks)]
+
+
+def update_subscribers(publishers, update, session):
+    """Call update(publisher, session) under each publisher's subscriber
+    lock. Many publishers are grouped by stripe so each lock is taken once;
+    fewer than there are stripes seldom share one and go one by one."""
+    if len(publishers) < len(subscriber_locks):
+        for publisher in publishers:
+            with subscriber_lock(publisher):
+                update(publisher, session)
+        return
+    stripes = {}
+    for publisher in publishers:
+        stripes.setdefault(subscriber_lock(publisher), []).append(publisher)
+    for lock, group in stripes.items():
+        with lock:
+            for publisher in group:
+                update(publisher, session)
+
+
+def watch_channel(channel):
+    channel_changes.put(("subscribe", channel))
+
+
+def unwatch_channel(channel):
+    channel_changes.put(("unsubscribe", channel))
+
+
+# The helpers below must be called with room_lock(room) or
+# subscriber_lock(publisher) held. They keep the node subscribed to exactly
+# the room:/notify: channels it has local sockets for.
+def add_room_session(room, session):
+    members = room_sessions.get(room)
+    if members is None:
+        members = room_sessions[room] = set()
+        watch_channel(room_channel(room))
+    members.add(session)
+
+
+def discard_room_session(room, session):
+    members = room_sessions.get(room)
+    if members is None:
+        return
+    members.discard(session)
+    if room != MAIN_ROOM and not members:
+        room_sessions.pop(room, None)
+        unwatch_channel(room_channel(room))
+
+
+def add_subscriber(publisher, session):
+    followers = subscribers.get(publisher)
+    if followers is None:
+        followers = subscribers[publisher] = set()
+        watch_channel(notify_key(publisher))
+    followers.add(session)
+    subscriber_snapshots.pop(publisher, None)
+
+
+def discard_subscriber(publisher, session):
+    followers = subscribers.get(publisher)
+    if followers is None:
+        return
+    followers.discard(session)
+    subscriber_snapshots.pop(publisher, None)
+    if not followers:
+        subscribers.pop(publisher, None)
+        unwatch_channel(notify_key(publisher))
+
+
+class OutboundQueue:
+    """Bounded send queue for one client, drained by its own writer thread."""
+
+    __slots__ = ("conn", "items", "cond", "closed", "sent", "dropped", "thread")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, data, deadline=None):
+        """Queue data for the client. With the block policy a full queue is
+        waited on for BACKPRESSURE_BLOCK_SECONDS, but never past deadline
+        (a time.monotonic() value shared by one delivery batch)."""
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= OUTBOUND_QUEUE_SIZE:
+                if BACKPRESSURE_POLICY == "disconnect":
+                    self.dropped += 1
+                    self._disconnect()
+                    return False
+                if BACKPRESSURE_POLICY == "block":
+                    timeout = BACKPRESSURE_BLOCK_SECONDS
+                    if deadline is not None:
+                        timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+                    has_room = self.cond.wait_for(
+                        lambda: self.closed or len(self.items) < OUTBOUND_QUEUE_SIZE,
+                        timeout=timeout
+                    )
+                    if self.closed:
+                        return False
+                    if not has_room:
+                        self.dropped += 1
+                        return False
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            self.items.append(data)
+            self.cond.notify_all()
+            return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.items)
+                if self.closed:
+                    return
+                data = self.items.popleft()
+                count = 1
+                if COALESCE_WINDOW_MS > 0 and self.items:
+                    # One sendall, and so one TLS record and syscall, for
+                    # everything queued so far.
+                    batch = [data]
+                    size = len(data)
+                    while self.items and size < COALESCE_MAX_BYTES:
+                        batch.append(self.items.popleft())
+                        size += len(batch[-1])
+                    data = b"".join(batch)
+                    count = len(batch)
+                self.cond.notify_all()
             try:
-                s.sendall(text.encode())
-            except:
-                pass
+                start = time.perf_counter()
+                self.conn.sendall(data)
+                send_seconds.observe(time.perf_counter() - start)
+                self.sent += count
+            except OSError:
+                self.close()
+                return
+
+    def _disconnect(self):
+        # Called with self.cond held. Shutting the raw socket down wakes the
+        # client's reader thread, which then runs the normal cleanup.
+        self.closed = True
+        self.items.clear()
+        self.cond.notify_all()
+        try:
+            socket.socket.shutdown(self.conn, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"depth": len(self.items), "sent": self.sent, "dropped": self.dropped}
+
+
+def send_line(session, text):
+    session.outbound.put(text.encode())
+
+
+def delivery_deadline():
+    """Deadline for one fan-out under the block policy. The listener and
+    the notification thread deliver for the whole node, so slow clients
+    may hold up a batch for BACKPRESSURE_BLOCK_SECONDS in total, not each."""
+    if BACKPRESSURE_POLICY != "block":
+        return None
+    return time.monotonic() + BACKPRESSURE_BLOCK_SECONDS
+
+
+# data is the already encoded message; the same buffer is queued for every
+# recipient. A session that disconnects after the snapshot has a closed
+# writer, which ignores the put.
+def deliver_to_local(room, data, sender=None, origin=None):
+    with room_lock(room):
+        members = tuple(room_sessions.get(room, ()))
+    skip_sender = sender and origin == SERVER_ID
+    deadline = delivery_deadline()
+    for session in members:
+        if skip_sender and session.user == sender:
+            continue
+        session.outbound.put(data, deadline)
+
+
+def batch_payloads(messages, origin):
+    """Joined text of a room_batch for most recipients, plus, when the batch
+    came from this node, a variant per local sender without their own lines."""
+    data = memoryview(b"".join(text for _, text in messages))
+    own = {}
+    if origin == SERVER_ID:
+        for sender in {s for s, _ in messages if s}:
+            own[sender] = memoryview(b"".join(text for s, text in messages if s != sender))
+    return data, own
+
+
+def deliver_batch_to_local(room, messages, origin=None):
+    with room_lock(room):
+        members = tuple(room_sessions.get(room, ()))
+    data, own = batch_payloads(messages, origin)
+    deadline = delivery_deadline()
+    for session in members:
+        payload = own.get(session.user, data) if own else data
+        if payload:
+            session.outbound.put(payload, deadline)
 
 
 def deliver_notification_to_local(publisher, message):
-    with state_lock:
-        sockets = subscribers.get(publisher, set()).copy()
-        for s in sockets:
-            try:
-                s.sendall(f"Notification from {publisher}: {message}\n".encode())
-            except:
-                pass
+    with subscriber_lock(publisher):
+        followers = subscriber_snapshots.get(publisher)
+        if followers is None and publisher in subscribers:
+            followers = subscriber_snapshots[publisher] = tuple(subscribers[publisher])
+    if not followers:
+        return
+    data = memoryview(f"Notification from {publisher}: ".encode() + message + b"\n")
+    notification_deliveries.put((followers, data))
+
+
+def start_notification_delivery():
+    """Deliver notifications off the listener thread, FANOUT_CHUNK_SIZE
+    followers at a time.
+
+    Every notification goes through this one thread, so each follower gets
+    a publisher's notifications in order whatever its follower count.
+    """
+    chunk = max(FANOUT_CHUNK_SIZE, 1)
+    while True:
+        followers, data = notification_deliveries.get()
+        deadline = delivery_deadline()
+        for start in range(0, len(followers), chunk):
+            for session in followers[start:start + chunk]:
+                session.outbound.put(data, deadline)
+            # Let the listener and session threads take the GIL.
+            time.sleep(0)
+
+
+def observe_delivery(payload_type, sent_at):
+    # Wall clocks of different servers; assumed NTP-synchronised.
+    delivery_seconds.observe(max(0.0, time.time() - sent_at), payload_type)
+
+
+def apply_channel_changes(pubsub):
+    pending = {}
+    while True:
+        try:
+            action, channel = channel_changes.get_nowait()
+        except queue.Empty:
+            break
+        pending[channel] = action
+
+    for action in ("subscribe", "unsubscribe"):
+        channels = [c for c, a in pending.items() if a == action]
+        sharded = [c for c in channels if is_sharded_channel(c)]
+        plain = [c for c in channels if not is_sharded_channel(c)]
+        if sharded:
+            getattr(pubsub, "s" + action)(*sharded)
+        if plain:
+            getattr(pubsub, action)(*plain)
+
+
+def is_sharded_channel(channel):
+    return REDIS_SHARDED_PUBSUB and channel.startswith(room_channel(""))
+
+
+def next_pubsub_message(pubsub):
+    # A cluster keeps sharded subscriptions on per-node connections of their
+    # own; drain those without blocking, then wait on the rest.
+    if REDIS_CLUSTER:
+        message = pubsub.get_sharded_message()
+        if message:
+            return message
+    return pubsub.get_message(timeout=PUBSUB_POLL_SECONDS)
 
 
 def start_pubsub_listener():
-    pubsub = redis_client.pubsub()
-    pubsub.psubscribe("room:*", "notify:*")
-    for message in pubsub.listen():
-        if message.get("type") != "pmessage":
+    pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+    # The lobby always exists locally, so the connection is never idle.
+    watch_channel(room_channel(MAIN_ROOM))
+    pubsub.subscribe(presence_channel())
+    presence = presence_channel().encode()
+    while True:
+        apply_channel_changes(pubsub)
+        message = next_pubsub_message(pubsub)
+        if not message or message.get("type") not in ("message", "smessage"):
             continue
         data = message.get("data")
         if not data:
             continue
-        try:
-            payload = json.loads(data)
-        except Exception:
+        if message.get("channel") == presence:
+            presence_cache.apply(data.decode())
             continue
-        payload_type = payload.get("type")
+        envelope = decode_envelope(data)
+        if envelope is None:
+            continue
+        payload_type, target, sender, origin, sent_at, body = envelope
         if payload_type == "room_message":
-            deliver_to_local(
-                payload.get("room"),
-                payload.get("text"),
-                payload.get("sender"),
-                payload.get("origin")
-            )
+            deliver_to_local(target, body, sender, origin)
+        elif payload_type == "room_batch":
+            deliver_batch_to_local(target, body, origin)
         elif payload_type == "notify_message":
-            deliver_notification_to_local(
-                payload.get("publisher"),
-                payload.get("message")
-            )
+            deliver_notification_to_local(target, body)
+        observe_delivery(payload_type, sent_at)
 
 
 def start_heartbeat():
     while True:
-        with state_lock:
-            users = list(active_users_local)
-            for user in users:
-                if not refresh_active_user(user):
-                    active_users_local.discard(user)
+        with sessions_lock:
+            users = [session.user for session in sessions if session.leased]
+        try:
+            lost = refresh_active_users(users)
+        except redis.RedisError as e:
+            print(f"Heartbeat error: {e}")
+            recover_control_node(e)
+            lost = set()
+        if lost:
+            with sessions_lock:
+                for session in sessions:
+                    if session.user in lost:
+                        session.leased = False
+        try:
+            refresh_node().execute()
+            sync_presence()
+            reap_dead_nodes()
+        except redis.RedisError as e:
+            print(f"Presence sync error: {e}")
+            recover_control_node(e)
         threading.Event().wait(HEARTBEAT_INTERVAL_SECONDS)
 
 
 
-def register_user(user, pwd):
-    user_credentials[user] = hash_password(pwd)
+def register_user(user, pwd, overwrite=True):
+    stored = bcrypt.hashpw(hash_password(pwd).encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+    redis_client.set(credentials_key(user), stored, nx=not overwrite)
 
 
-def send_to_room(room, text, skip_conn=None):
-    sender = None
-    if skip_conn is not None:
-        sender = connection_to_user.get(skip_conn)
-    publish_room_message(room, text, sender)
-
-
-def move_user(user, target_room, conn):
-    with state_lock:
-        current_room = user_location[user]
-        room_connections[current_room].discard(conn)
-
-        if current_room != MAIN_ROOM and not room_connections[current_room]:
-            room_connections.pop(current_room, None)
-
-        room_connections.setdefault(target_room, set()).add(conn)
-        user_location[user] = target_room
-
-    remove_user_from_room(user, current_room)
-    add_user_to_room(user, target_room)
+def register_default_users():
+    for u in "abcdefgh":
+        if not redis_client.exists(credentials_key(u)):
+            register_user(u, "1", overwrite=False)
 
 
+def user_exists(user):
+    return bool(redis_client.exists(credentials_key(user)))
 
 
-def process_input(conn, user, command):
+def check_password(client_hash, stored_hash):
+    try:
+        return bcrypt.checkpw(client_hash.encode(), stored_hash.encode())
+    except ValueError:
+        return False
+
+
+def verify_credentials(user, client_hash):
+    start = time.perf_counter()
+    verified = check_credentials(user, client_hash)
+    auth_seconds.observe(time.perf_counter() - start, "ok" if verified else "failed")
+    return verified
+
+
+def check_credentials(user, client_hash):
+    stored_hash = redis_client.get(credentials_key(user))
+    if stored_hash is None:
+        return False
+    key = verification_cache.key(user, client_hash, stored_hash)
+    if verification_cache.get(key):
+        return True
+    if not auth_pool.submit(check_password, client_hash, stored_hash).result():
+        return False
+    verification_cache.add(key)
+    return True
+
+
+def send_to_room(room, text, skip_session=None, record=False):
+    sender = skip_session.user if skip_session is not None else None
+    publish_room_message(room, text, sender, record)
+
+
+def move_user(session, target_room):
+    """Move the session's user and return the target room's recent
+    history, read in the same round-trip as the membership update."""
+    user = session.user
+    current_room = session.room
+    with room_lock(current_room):
+        discard_room_session(current_room, session)
+    with room_lock(target_room):
+        add_room_session(target_room, session)
+    session.room = target_room
+
+    pipe = redis_client.pipeline(transaction=False)
+    remove_user_from_room(user, current_room, pipe)
+    add_user_to_room(user, target_room, pipe)
+    if not history_enabled():
+        pipe.execute()
+        return []
+    if REDIS_CLUSTER:
+        # History lives on the shard of its room, not with the control state.
+        pipe.execute()
+        return history_lines(publish_client.xrevrange(history_key(target_room), count=HISTORY_BACKFILL))
+    pipe.xrevrange(history_key(target_room), count=HISTORY_BACKFILL)
+    return history_lines(pipe.execute()[2])
+
+
+
+
+def connection_take(session):
+    """take() of the session's own bucket. Idle sessions, and every session
+    while the connection limit is off, never allocate one."""
+    bucket = session.bucket
+    if bucket is None:
+        if RATE_LIMIT_CONNECTION_RATE <= 0:
+            return 0.0
+        bucket = session.bucket = TokenBucket(RATE_LIMIT_CONNECTION_RATE, RATE_LIMIT_CONNECTION_BURST)
+    return bucket.take()
+
+
+def rate_limited(session, level, take):
+    """Apply RATE_LIMIT_POLICY to a line; take is the take() of the bucket
+    for level. True if the line must be skipped."""
+    wait = take()
+    if not wait:
+        return False
+    rate_limited_lines.inc(label_value=level)
+    session.limited += 1
+    if RATE_LIMIT_POLICY == "throttle":
+        # While this thread sleeps nothing reads the socket, so TCP pushes
+        # back on the client.
+        while wait:
+            time.sleep(min(wait, RATE_LIMIT_SYNC_SECONDS))
+            wait = take()
+        return False
+    if RATE_LIMIT_POLICY == "disconnect":
+        try:
+            socket.socket.shutdown(session.conn, socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return True
+    send_line(session, f"Rate limit exceeded ({level}), message dropped\n")
+    return True
+
+
+def process_input(session, command):
+    user = session.user
+    if (rate_limited(session, "connection", lambda: connection_take(session))
+            or rate_limited(session, "user", lambda: user_limits.take(user))):
+        return
     try:
         if command.startswith("/join "):
             new_room = command.split(maxsplit=1)[1]
-            with state_lock:
-                old_room = user_location[user]
+            old_room = session.room
 
-            move_user(user, new_room, conn)
+            history = move_user(session, new_room)
 
-            conn.sendall(f"Joined room {new_room}\n".encode())
+            send_line(session, f"Joined room {new_room}\n")
+            if history:
+                send_line(session, format_history(new_room, history))
             send_to_room(old_room, f"{user} left {old_room}\n")
-            send_to_room(new_room, f"{user} joined {new_room}\n", conn)
+            send_to_room(new_room, f"{user} joined {new_room}\n", session)
 
         elif command == "/leave":
-            with state_lock:
-                old_room = user_location[user]
+            old_room = session.room
 
-            move_user(user, MAIN_ROOM, conn)
+            history = move_user(session, MAIN_ROOM)
 
-            conn.sendall(f"Returned to {MAIN_ROOM}\n".encode())
+            send_line(session, f"Returned to {MAIN_ROOM}\n")
+            if history:
+                send_line(session, format_history(MAIN_ROOM, history))
             send_to_room(old_room, f"{user} left {old_room}\n")
-            send_to_room(MAIN_ROOM, f"{user} joined {MAIN_ROOM}\n", conn)
+            send_to_room(MAIN_ROOM, f"{user} joined {MAIN_ROOM}\n", session)
 
-        elif command == "/rooms":
-            rooms = sorted(redis_client.smembers("rooms"))
-            listing = ", ".join(
-                f"{r}({redis_client.scard(room_key(r))})" for r in rooms
-            )
-            conn.sendall(f"Available rooms: {listing}\n".encode())
+        elif command == "/rooms" or command.startswith("/rooms "):
+            send_line(session, format_room_listing(room_listing(), command[len("/rooms"):]))
         
-        elif command == "/users":
-            users = sorted(redis_client.smembers(online_users_key()))
-            listing = ", ".join(users)
-            conn.sendall(f"Users online: {listing}\n".encode())
+        elif command == "/users" or command.startswith("/users "):
+            send_line(session, format_user_listing(command[len("/users"):]))
 
         elif command.startswith("/subscribe"):
             user_to_subscribe = command.split(maxsplit=1)[1]
-            with state_lock:
-                if user_to_subscribe not in user_credentials:
-                    conn.sendall("User does not exist\n".encode())
-                    return
-                subscribers.setdefault(user_to_subscribe, set()).add(conn)
-                subscriptions.setdefault(user, set()).add(user_to_subscribe)
-                redis_client.sadd(subscriptions_key(user), user_to_subscribe)
-                redis_client.sadd(subscribers_key(user_to_subscribe), user)
-                conn.sendall(f"Subscribed to {user_to_subscribe}\n".encode())
+            if not user_exists(user_to_subscribe):
+                send_line(session, "User does not exist\n")
+                return
+            with subscriber_lock(user_to_subscribe):
+                add_subscriber(user_to_subscribe, session)
+            session.subscriptions.add(user_to_subscribe)
+            redis_client.sadd(subscriptions_key(user), user_to_subscribe)
+            redis_client.sadd(subscribers_key(user_to_subscribe), user)
+            send_line(session, f"Subscribed to {user_to_subscribe}\n")
 
         elif command.startswith("/unsubscribe"):
             user_to_unsubscribe = command.split(maxsplit=1)[1]
-            with state_lock:
-                if user_to_unsubscribe not in user_credentials:
-                    conn.sendall("User does not exist\n".encode())
-                    return
-                if user_to_unsubscribe in subscribers:
-                    subscribers[user_to_unsubscribe].discard(conn)
-                    if not subscribers[user_to_unsubscribe]:
-                        subscribers.pop(user_to_unsubscribe, None)
-                if user in subscriptions:
-                    subscriptions[user].discard(user_to_unsubscribe)
-                    if not subscriptions[user]:
-                        subscriptions.pop(user, None)
-                redis_client.srem(subscriptions_key(user), user_to_unsubscribe)
-                redis_client.srem(subscribers_key(user_to_unsubscribe), user)
-                conn.sendall(f"Unsubscribed from {user_to_unsubscribe}\n".encode())
+            if not user_exists(user_to_unsubscribe):
+                send_line(session, "User does not exist\n")
+                return
+            with subscriber_lock(user_to_unsubscribe):
+                discard_subscriber(user_to_unsubscribe, session)
+            session.subscriptions.discard(user_to_unsubscribe)
+            redis_client.srem(subscriptions_key(user), user_to_unsubscribe)
+            redis_client.srem(subscribers_key(user_to_unsubscribe), user)
+            send_line(session, f"Unsubscribed from {user_to_unsubscribe}\n")
         
         elif command.startswith("/publish"):
             message = command.split(maxsplit=1)[1]
             publish_notification(user, message)
+
+        elif command == "/drain":
+            if user not in ADMIN_USERS:
+                send_line(session, "Not allowed\n")
+                return
+            send_line(session, f"Draining server {SERVER_ID}\n")
+            # Same path as a deploy's SIGTERM, run from the main thread.
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        elif command == "/stats":
+            stats = session.outbound.stats()
+            send_line(
+                session,
+                f"Outbound queue: depth={stats['depth']} sent={stats['sent']} "
+                f"dropped={stats['dropped']} policy={BACKPRESSURE_POLICY}\n"
+            )
+            stats = admission.stats()
+            send_line(
+                session,
+                f"Admission: accepted={stats['accepted']} deferred={stats['deferred']} "
+                f"rejected={stats['rejected']}\n"
+            )
+            send_line(session, format_pool_stats(pool_meters.values()))
+            send_line(session, f"Rate limited: {session.limited} lines, policy={RATE_LIMIT_POLICY}\n")
         else:
-            room = user_location[user]
-            send_to_room(room, f"{user}: {command}\n", conn)
+            room = session.room
+            if rate_limited(session, "room", lambda: room_limits.take(room)):
+                return
+            send_to_room(room, f"{user}: {command}\n", session, record=True)
 
     except Exception as e:
         print(f"Error processing command from {user}: {e}")
-        conn.sendall("Error processing command\n".encode())
+        send_line(session, "Error processing command\n")
 
 
 
 
-def authenticate(conn):
-    data = ""
-    while "\n" not in data:
-        packet = conn.recv(1024).decode()
-        if not packet:
-            return False, ""
-        data += packet
+def authenticate(conn, framer):
+    """Returns (logged_in, user, room); room is set for a resumed session."""
     try:
-        line = data.strip()
-        parts = line.split(maxsplit=2)
+        line = framer.read_line(conn)
+        if line is None:
+            return False, "", None
+        parts = line.decode().strip().split(maxsplit=2)
+
+        if len(parts) == 3 and parts[0] == "RESUME":
+            return resume(conn, parts[1], parts[2])
 
         if len(parts) != 3 or parts[0] != "LOGIN":
             conn.sendall("Invalid login request\n".encode())
             conn.close()
-            return False, ""
+            return False, "", None
 
         _, user, client_hash = parts
 
-        if user not in user_credentials:
-            conn.sendall("Authentication failed\n".encode())
+        if not admission.admit():
+            conn.sendall(admission.busy_message().encode())
             conn.close()
-            return False, ""
+            return False, "", None
+        try:
+            verified = verify_credentials(user, client_hash)
+        finally:
+            admission.release()
 
-        if client_hash != user_credentials[user]:
+        if not verified:
             conn.sendall("Authentication failed\n".encode())
             conn.close()
-            return False, ""
+            return False, "", None
 
         if not set_active_user(user):
             conn.sendall("User already active\n".encode())
             conn.close()
-            return False, ""
+            return False, "", None
 
         conn.sendall(f"Login successful. Room: {MAIN_ROOM}\n".encode())
-        return True, user
+        return True, user, None
     
     except Exception as e:
         print(f"Authentication error: {e}")
         conn.sendall("Authentication failed\n".encode())
         conn.close()
-        return False, ""
+        return False, "", None
+
+
+def resume(conn, user, token):
+    """RESUME <user> <token>: pick up a session handed off by a draining
+    server, without bcrypt."""
+    room = resume_session_script(**resume_script_args(user, token))
+    if room is None:
+        resumes.inc(label_value="rejected")
+        conn.sendall("Resume failed\n".encode())
+        conn.close()
+        return False, "", None
+    resumes.inc(label_value="resumed")
+    conn.sendall(f"Resume successful. Room: {room}\n".encode())
+    return True, user, room
 
 
 
 
-def client_session(conn, addr):
-    logged_in = False
-    username = None
+def tls_handshake(sock, ssl_context):
+    """Runs the handshake on the client's thread, so a slow or silent peer
+    never stalls the accept loop."""
+    if not admission.admit():
+        # No TLS yet, so the reply is plain text. Only plain TCP peers can
+        # read it; TLS clients just see a failed handshake, without the
+        # retry hint.
+        try:
+            sock.sendall(admission.busy_message().encode())
+        except OSError:
+            pass
+        sock.close()
+        return None
+    try:
+        sock.settimeout(HANDSHAKE_TIMEOUT_SECONDS)
+        conn = ssl_context.wrap_socket(sock, server_side=True)
+        conn.settimeout(None)
+    except (OSError, ssl.SSLError):
+        sock.close()
+        return None
+    finally:
+        admission.release()
+    admission.record_accepted()
+    return conn
+
+
+def add_subscriptions(session, publishers):
+    """Attach a session to the notifications of many publishers at once."""
+    session.subscriptions.update(publishers)
+    update_subscribers(publishers, add_subscriber, session)
+
+
+def detach_session(session):
+    """Stop delivering to a finished session and return its room.
+
+    One room update plus one subscriber-set update per subscription, taking
+    each subscriber lock once. The session stays in sessions, unleased,
+    until its Redis cleanup is done.
+    """
+    room = session.room
+    with room_lock(room):
+        discard_room_session(room, session)
+    update_subscribers(session.subscriptions, discard_subscriber, session)
+    with sessions_lock:
+        session.leased = False
+    session.outbound.close()
+    return room
+
+
+def client_session(sock, addr, ssl_context):
+    session = None
+
+    conn = tls_handshake(sock, ssl_context)
+    if conn is None:
+        return
 
     try:
-        logged_in, username = authenticate(conn)
+        framer = LineFramer()
+        logged_in, username, resumed_room = authenticate(conn, framer)
         if not logged_in:
             return
 
-        with state_lock:
-            connection_to_user[conn] = username
-            user_location[username] = MAIN_ROOM
-            room_connections[MAIN_ROOM].add(conn)
-            active_users_local.add(username)
+        session = Session(conn, username, OutboundQueue(conn))
+        session.room = resumed_room or MAIN_ROOM
+        with sessions_lock:
+            sessions.add(session)
+        with room_lock(session.room):
+            add_room_session(session.room, session)
 
-            saved_subscriptions = set(redis_client.smembers(subscriptions_key(username)))
-            if saved_subscriptions:
-                subscriptions[username] = saved_subscriptions
-                for subscribed_user in saved_subscriptions:
-                    subscribers.setdefault(subscribed_user, set()).add(conn)
+        saved_subscriptions, inbox = restore_session_state(username)
+        add_subscriptions(session, saved_subscriptions)
+        if inbox:
+            send_line(session, format_inbox(inbox))
 
-        add_user_to_room(username, MAIN_ROOM)
-        redis_client.sadd(online_users_key(), username)
+        add_user_to_room(username, session.room)
+        register_session(username).execute()
 
-        send_to_room(MAIN_ROOM, f"{username} joined the lobby\n", conn)
+        if resumed_room is None:
+            send_to_room(MAIN_ROOM, f"{username} joined the lobby\n", session)
 
-        buffer = ""
         while True:
-            data = conn.recv(1024).decode()
-            if not data:
+            try:
+                lines = framer.read_lines(conn)
+            except LineTooLong:
+                send_line(session, "Line too long\n")
+                continue
+            if lines is None:
                 break
-
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                process_input(conn, username, line.strip())
+            for line in lines:
+                process_input(session, line.decode().strip())
 
     except Exception as e:
         print(f"Client error {addr}: {e}")
 
     finally:
-        if logged_in:
-            with state_lock:
-                room = user_location.pop(username, None)
-                if room:
-                    room_connections[room].discard(conn)
+        try:
+            if session is not None:
+                room = detach_session(session)
+                handed_off = False
+                try:
+                    if session.resume_token:
+                        pipe = hand_off_session(session.user, room, session.resume_token)
+                        remove_user_from_room(session.user, room, pipe)
+                        release_active_user_script(**release_script_args(session.user), client=pipe)
+                        pipe.execute()
+                        resumes.inc(label_value="handed_off")
+                        handed_off = True
+                    else:
+                        remove_user_from_room(session.user, room)
+                        unregister_session(session.user).execute()
+                        release_active_user(session.user)
+                        send_to_room(room, f"{session.user} disconnected\n")
+                except Exception as e:
+                    # The session is unleased, so its lease runs out on its
+                    # own; the client is not sent a RECONNECT it cannot use.
+                    print(f"Cleanup error for {session.user}: {e}")
+                if handed_off:
+                    # Only now that Redis no longer has the session here may
+                    # the client resume elsewhere. The line goes out after the
+                    # writer thread's last send, never alongside it.
+                    session.outbound.thread.join(1)
+                    if not session.outbound.thread.is_alive():
+                        try:
+                            conn.sendall(reconnect_line(session.resume_token).encode())
+                        except OSError:
+                            pass
+        finally:
+            if session is not None:
+                with sessions_lock:
+                    sessions.discard(session)
+            conn.close()
 
-                    if room != MAIN_ROOM and not room_connections[room]:
-                        room_connections.pop(room, None)
-                for subscribed_user in subscriptions.get(username, set()):
-                    if subscribed_user in subscribers:
-                        subscribers[subscribed_user].discard(conn)
-                        if not subscribers[subscribed_user]:
-                            subscribers.pop(subscribed_user, None)
 
-                subscriptions.pop(username, None)
 
-                connection_to_user.pop(conn, None)
 
-                if room:
-                    remove_user_from_room(username, room)
-                redis_client.delete(session_key(username))
-                release_active_user(username)
-                redis_client.srem(online_users_key(), username)
+def create_ssl_context():
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(
+        certfile=os.environ.get("CERT_FILE", "cert.pem"),
+        keyfile=os.environ.get("KEY_FILE", "key.pem")
+    )
+    # Ticket keys are per process, so a client resumes only when it
+    # reconnects to the same server instance; elsewhere it falls back to a
+    # full handshake.
+    ssl_context.num_tickets = TLS_SESSION_TICKETS
+    if TLS_SESSION_TICKETS == 0:
+        ssl_context.options |= ssl.OP_NO_TICKET
+    # A read-side EOF (drain_sessions' SHUT_RD, or a client that just drops
+    # the connection) reads as a clean close instead of failing the
+    # connection, so the RECONNECT line can still be sent.
+    ssl_context.options |= ssl.OP_IGNORE_UNEXPECTED_EOF
+    return ssl_context
+
+
+def start_metrics(connection_count, room_count, queue_depths, meters):
+    """Register the engine's gauges and serve /metrics on METRICS_PORT.
+
+    queue_depths returns the outbound queue depth of every connection.
+    """
+    metrics.Gauge("chat_connections", "Logged-in client connections", connection_count)
+    metrics.Gauge("chat_local_rooms", "Rooms with at least one local connection", room_count)
+    metrics.Gauge("chat_outbound_queued", "Messages queued for clients, all connections",
+                  lambda: sum(queue_depths()))
+    metrics.Gauge("chat_outbound_queue_max", "Deepest outbound queue of any connection",
+                  lambda: max(queue_depths(), default=0))
+    metrics.Gauge("chat_admission_total", "Connections by admission decision", admission.stats,
+                  label="result", kind="counter")
+    metrics.Gauge("chat_auth_cache_total", "Logins by verification cache result",
+                  verification_cache.stats, label="result", kind="counter")
+    metrics.Gauge("chat_coalesced_total", "Coalesced room messages and the publishes that carried them",
+                  coalescer.stats, label="kind", kind="counter")
+    metrics.Gauge("chat_rate_limit_buckets", "User and room rate limit buckets tracked here",
+                  lambda: {"user": user_limits.stats(), "room": room_limits.stats()}, label="level")
+    metrics.Gauge("chat_redis_pool_in_use", "Pooled Redis connections checked out",
+                  lambda: {m.name: m.stats()["in_use"] for m in meters}, label="pool")
+    metrics.Gauge("chat_redis_pool_waits_total", "Redis commands that waited for a pooled connection",
+                  lambda: {m.name: m.stats()["waits"] for m in meters}, label="pool", kind="counter")
+    if METRICS_PORT > 0:
+        # A taken port must not stop the chat server (a worker would be
+        # restarted into the same error forever); it runs without /metrics.
+        try:
+            metrics.serve(SERVER_HOST, METRICS_PORT)
+        except OSError as e:
+            print(f"Metrics disabled, cannot listen on port {METRICS_PORT}: {e}")
+            return
+        print(f"Metrics on http://{SERVER_HOST}:{METRICS_PORT}/metrics")
 
-                send_to_room(room, f"{username} disconnected\n")
 
-        conn.close()
+class ShutdownRequested(Exception):
+    pass
 
 
+def request_shutdown(signum, frame):
+    # A second signal gets the default action and ends the process at once.
+    signal.signal(signum, signal.SIG_DFL)
+    raise ShutdownRequested()
+
+
+def drain_sessions(timeout):
+    """Hand every session off (close it, with RESUME_TTL_SECONDS=0) and wait
+    until they have left their rooms and released their leases."""
+    with sessions_lock:
+        snapshot = list(sessions)
+    for session in snapshot:
+        try:
+            if RESUME_TTL_SECONDS > 0:
+                session.resume_token = secrets.token_hex(16)
+                # Ends the session's read loop; TLS stays usable for sending
+                # the RECONNECT line.
+                socket.socket.shutdown(session.conn, socket.SHUT_RD)
+            else:
+                session.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    deadline = time.monotonic() + timeout
+    while sessions and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def retire_node():
+    """Reap sessions that did not finish draining and leave the registry."""
+    reaped = reap_node(SERVER_ID)
+    heartbeat_client.delete(node_key(SERVER_ID))
+    return reaped
+
+
+def worker_args(argv):
+    """Command-line arguments for the workers: the supervisor's own,
+    without --workers."""
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--workers":
+            skip = True
+        elif not arg.startswith("--workers="):
+            args.append(arg)
+    return args
+
+
+def run_workers(count):
+    """Run count server processes on SERVER_PORT, each with its own GIL.
+
+    Workers bind the port with SO_REUSEPORT, so the kernel spreads new
+    connections across them, and share all state through Redis like
+    separate servers do: worker n is SERVER_ID-n with metrics on
+    METRICS_PORT + n. A worker that exits is restarted, with backoff if it
+    keeps dying right after start. SIGTERM/SIGINT is passed on to the
+    workers, which drain before the supervisor exits.
+    """
+    def spawn(index):
+        env = dict(os.environ)
+        env.update({
+            "SERVER_WORKERS": "1",
+            "SERVER_REUSE_PORT": "1",
+            "SERVER_ID": f"{SERVER_ID}-{index}",
+            "METRICS_PORT": str(METRICS_PORT + index if METRICS_PORT > 0 else 0),
+        })
+        # Own session: a terminal's Ctrl-C reaches only the supervisor.
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), *worker_args(sys.argv[1:])],
+                                env=env, start_new_session=True)
+
+    workers = [spawn(index) for index in range(count)]
+    started = [time.monotonic()] * count
+    crashes = [0] * count
+    restart_at = [None] * count
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    print(f"Supervising {count} workers on port {SERVER_PORT}")
+
+    while not stopping:
+        time.sleep(0.5)
+        now = time.monotonic()
+        for index, proc in enumerate(workers):
+            if proc is None:
+                if now >= restart_at[index]:
+                    workers[index] = spawn(index)
+                    started[index] = now
+                continue
+            code = proc.poll()
+            if code is None or stopping:
+                continue
+            crashes[index] = crashes[index] + 1 if now - started[index] < 10 else 0
+            delay = min(2 ** crashes[index], 30) if crashes[index] else 0
+            print(f"Worker {index} exited with status {code}, restarting in {delay}s")
+            workers[index] = None
+            restart_at[index] = now + delay
+
+    print(f"Stopping {count} workers")
+    running = [proc for proc in workers if proc is not None and proc.poll() is None]
+    for proc in running:
+        proc.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS + 5
+    for proc in running:
+        try:
+            proc.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
 
 
 def start_server():
-    for u in "abcdefgh":
-        register_user(u, "1")
+    if REDIS_SHARDED_PUBSUB:
+        check_sharded_pubsub()
+    load_scripts()
+    register_default_users()
 
-    redis_client.sadd("rooms", MAIN_ROOM)
+    init_room_index()
+    # Sessions indexed under our id belong to a previous run that crashed
+    # (SERVER_ID is often fixed, e.g. in docker-compose).
+    reap_node(SERVER_ID)
+    refresh_node().execute()
 
     threading.Thread(target=start_pubsub_listener, daemon=True).start()
     threading.Thread(target=start_heartbeat, daemon=True).start()
-
-    # Create SSL context
-    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    ssl_context.load_cert_chain(
-        certfile=os.environ.get("CERT_FILE", "cert.pem"),
-        keyfile=os.environ.get("KEY_FILE", "key.pem")
+    threading.Thread(target=start_notification_delivery, daemon=True).start()
+    threading.Thread(target=start_rate_limit_sync, daemon=True).start()
+    if COALESCE_WINDOW_MS > 0:
+        threading.Thread(target=coalescer.run, daemon=True).start()
+    start_metrics(
+        lambda: len(sessions),
+        lambda: len(room_sessions),
+        lambda: [len(session.outbound.items) for session in list(sessions)],
+        pool_meters.values(),
     )
 
+    ssl_context = create_ssl_context()
+
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if SERVER_REUSE_PORT:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind((SERVER_HOST, SERVER_PORT))
-    
-    # Wrap socket with SSL
-    server = ssl_context.wrap_socket(server, server_side=True)
-    server.listen()
+    server.listen(LISTEN_BACKLOG)
 
     print(f"Chat server running on {SERVER_HOST}:{SERVER_PORT} (TLS enabled)")
 
-    while True:
-        conn, addr = server.accept()
-        threading.Thread(
-            target=client_session,
-            args=(conn, addr),
-            daemon=True
-        ).start()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    try:
+        while True:
+            # Over the accept rate, connections wait in the listen backlog.
+            wait = admission.reserve()
+            if wait:
+                time.sleep(wait)
+            conn, addr = server.accept()
+            threading.Thread(
+                target=client_session,
+                args=(conn, addr, ssl_context),
+                daemon=True
+            ).start()
+    except ShutdownRequested:
+        pass
+
+    server.close()
+    print(f"Draining {len(sessions)} connections")
+    drain_sessions(DRAIN_TIMEOUT_SECONDS)
+    retire_node()
 
 
 if __name__ == "__main__":
-    start_server()
+    # No abbreviations, so worker_args can find --workers.
+    parser = argparse.ArgumentParser(description="TLS chat server", allow_abbrev=False)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="processes sharing SERVER_PORT (default: SERVER_WORKERS or 1)")
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_workers(args.workers)
+    elif SERVER_ENGINE == "asyncio":
+        import async_server
+        async_server.start_server()
+    else:
+        start_server()